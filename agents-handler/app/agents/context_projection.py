@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional: without it tokens are estimated from length
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Agent name -> fields of the company document it actually reads
+AGENT_CONTEXT_FIELDS: Dict[str, Tuple[str, ...]] = {
+    "PostProposerTool": ("strategy", "company_context", "context_description", "brand_hero"),
+    "SceneDescTool": ("company_context", "brand_hero"),
+}
+
+# Agent name -> token budget for the projected context
+AGENT_CONTEXT_BUDGETS: Dict[str, int] = {
+    "PostProposerTool": int(os.getenv("POST_PROPOSER_CONTEXT_TOKENS", "1500")),
+    "SceneDescTool": int(os.getenv("SCENE_CONTEXT_TOKENS", "600")),
+}
+
+CONTEXT_TOKEN_ENCODING = os.getenv("CONTEXT_TOKEN_ENCODING", "o200k_base")
+
+# Strings are never cut below this many characters; lists and objects keep at least one item
+_MIN_STRING_CHARS = 40
+_ELLIPSIS = "…"
+_WHITESPACE = re.compile(r"\s+")
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding(CONTEXT_TOKEN_ENCODING)
+        except Exception as e:
+            logger.warning("tiktoken encoding %s unavailable (%s), estimating tokens", CONTEXT_TOKEN_ENCODING, e)
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Token count of `text`; roughly 4 characters per token without tiktoken."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def dumps_compact(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def _compact(value: Any) -> Any:
+    # Collapse whitespace and drop empty values, recursively
+    if isinstance(value, str):
+        return _WHITESPACE.sub(" ", value).strip()
+    if isinstance(value, dict):
+        items = ((k, _compact(v)) for k, v in value.items() if not str(k).startswith("_"))
+        return {k: v for k, v in items if v not in (None, "", [], {})}
+    if isinstance(value, (list, tuple)):
+        items = (_compact(v) for v in value)
+        return [v for v in items if v not in (None, "", [], {})]
+    return value
+
+
+def _leaves(value: Any, path: Tuple = ()) -> List[Tuple[Tuple, Any]]:
+    if isinstance(value, dict):
+        nested = [leaf for k, v in value.items() for leaf in _leaves(v, path + (k,))]
+        return ([(path, value)] if path else []) + nested
+    if isinstance(value, list):
+        return [(path, value)] + [leaf for i, v in enumerate(value) for leaf in _leaves(v, path + (i,))]
+    return [(path, value)]
+
+
+def _set(root: Any, path: Tuple, value: Any) -> None:
+    for key in path[:-1]:
+        root = root[key]
+    root[path[-1]] = value
+
+
+def _shrink(projection: Dict[str, Any], excess_chars: int) -> bool:
+    """
+    Shorten the longest string by about `excess_chars`; once all strings are short,
+    drop the last item of the longest list, then of the largest nested object. Returns False once nothing can be cut any more.
+    """
+    leaves = _leaves(projection)
+    # A string already cut to the minimum is as short as it gets (it ends in the ellipsis)
+    strings = [(path, v) for path, v in leaves if isinstance(v, str) and len(v) > _MIN_STRING_CHARS + len(_ELLIPSIS)]
+    if strings:
+        path, text = max(strings, key=lambda leaf: len(leaf[1]))
+        keep = max(_MIN_STRING_CHARS, len(text) - max(excess_chars, len(text) // 4))
+        shortened = text[:keep].rstrip() + _ELLIPSIS
+        if len(shortened) < len(text):
+            _set(projection, path, shortened)
+            return True
+    lists = [(path, v) for path, v in leaves if isinstance(v, list) and len(v) > 1]
+    if lists:
+        path, items = max(lists, key=lambda leaf: len(dumps_compact(leaf[1])))
+        _set(projection, path, items[:-1])
+        return True
+    # Last resort: drop trailing entries of the largest nested object
+    objects = [(path, v) for path, v in leaves if isinstance(v, dict) and len(v) > 1]
+    if objects:
+        path, fields = max(objects, key=lambda leaf: len(dumps_compact(leaf[1])))
+        _set(projection, path, dict(list(fields.items())[:-1]))
+        return True
+    return False
+
+
+def project_context(agent_name: str, doc: Optional[Dict[str, Any]], budget: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Reduce a company document to what `agent_name` needs: only its fields, compacted,
+    and cut down to its token budget so prompts stay bounded as documents grow.
+    """
+    fields = AGENT_CONTEXT_FIELDS[agent_name]
+    budget = budget if budget is not None else AGENT_CONTEXT_BUDGETS[agent_name]
+    projection = _compact({field: (doc or {}).get(field) for field in fields})
+
+    tokens = count_tokens(dumps_compact(projection))
+    original = tokens
+    while tokens > budget:
+        if not _shrink(projection, (tokens - budget) * 4):
+            logger.warning("Context for %s stays at %d tokens, over its budget of %d", agent_name, tokens, budget)
+            break
+        tokens = count_tokens(dumps_compact(projection))
+    if tokens != original:
+        logger.info("Context for %s truncated from %d to %d tokens", agent_name, original, tokens)
+    return projection
@@ -1,24 +1,24 @@
 import json
 import logging
 import os
-from openai import OpenAI
-from typing import Dict
+from typing import Any, Dict, Optional
 from agents import Agent, Runner, function_tool
+from app.schemas import ImageAgentOutput
+from app.clients.openai_client import get_openai_client
+from app.agents.registry import agent_model, get_agent, register_agent
 from dotenv import load_dotenv
 load_dotenv() 
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 logger = logging.getLogger(__name__)
 
-@function_tool(
-    strict_mode=False,
-    name_override='generate_image',
-    description_override='Generate a high-quality image with DALL·E using the scene description.'
-)
-async def generate_image(prompt: str) -> Dict[str, str]:
+# "pipeline" calls the scene and image steps directly; "agent" lets an LLM orchestrate them
+IMAGE_AGENT_MODE = os.getenv("IMAGE_AGENT_MODE", "pipeline")
+
+
+async def create_image(prompt: str) -> Dict[str, str]:
     try:
         logger.info(f"Generating image with prompt: {prompt[:50]}...")
-        img_resp = client.images.generate(prompt=prompt,
+        img_resp = await get_openai_client().images.generate(prompt=prompt,
         n=1,
         size="1024x1024")
         url = img_resp.data[0].url
@@ -27,36 +27,19 @@ async def generate_image(prompt: str) -> Dict[str, str]:
     except Exception as e:
         logger.error(f"Image generation failed: {str(e)}")
         return {"image_url": "", "error": str(e)}
-    
+
 
 @function_tool(
     strict_mode=False,
-    name_override='scene_description',
-    description_override='Create a concise scene description for the image, incorporating the brand hero.'
+    name_override='generate_image',
+    description_override='Generate a high-quality image with DALL·E using the scene description.'
 )
-async def scene_description(context_json: str) -> Dict[str, str]:
-    # Parse the enriched context that includes both post content and company data
-    try:
-        context = json.loads(context_json)
-        content = context.get("content", "")
-        company_data = context.get("company_data", {})
-        brand_hero = company_data.get("brand_hero", "")
-        
-        # Create an enriched prompt for the scene description
-        enriched_prompt = (
-            f"Post content: {content}\n"
-            f"Company context: {company_data.get('company_context', {})}\n"
-            f"Brand hero/mascot: {brand_hero}\n"
-            f"Create a vivid scene description incorporating the brand hero."
-        )
-        
-        logger.info(f"Generating scene description with enriched context")
-    except json.JSONDecodeError:
-        # Fallback if the input isn't valid JSON - treat it as simple content
-        logger.warning(f"Invalid JSON input to scene_description, using as plain text")
-        enriched_prompt = context_json
-    
-    agent = Agent(
+async def generate_image(prompt: str) -> Dict[str, str]:
+    return await create_image(prompt)
+
+
+def _build_scene_agent() -> Agent:
+    return Agent(
         name="SceneDescTool",
         instructions=(
             "You are a senior visual designer crafting prompts for DALL·E.\n\n"
@@ -81,19 +64,103 @@ async def scene_description(context_json: str) -> Dict[str, str]:
             "e.g. perched on a surface, interacting with an object, subtly placed in the frame—"
             "matching the company’s tone.\n\n"
             "OUTPUT: a single paragraph plain-text description—no JSON, no code fences."
-        )
+        ),
+        model=agent_model("SceneDescTool")
     )
-    res = await Runner.run(agent, enriched_prompt)
+
+
+def _build_scene_only_agent() -> Agent:
+    # Used when the company has a visual identity pack: the mascot's look is fixed there
+    return Agent(
+        name="SceneOnlyTool",
+        instructions=(
+            "You are a senior visual designer crafting prompts for DALL·E.\n\n"
+            "INPUT: the post caption and company context. The brand hero's appearance and the picture style "
+            "are fixed elsewhere and appended to your output.\n\n"
+            "TASK: Write one paragraph, max 600 characters, describing only the scene: environment & setting, "
+            "composition & perspective, lighting & mood, action & props that reinforce the caption, and the brand "
+            "hero's pose and placement. Refer to the mascot only as \"the brand hero\"; do not describe how it looks.\n\n"
+            "OUTPUT: a single paragraph plain-text description—no JSON, no code fences."
+        ),
+        model=agent_model("SceneDescTool")
+    )
+
+
+def _visual_identity(context_json: str) -> Optional[Dict[str, Any]]:
+    try:
+        context = json.loads(context_json)
+    except json.JSONDecodeError:
+        return None
+    return context.get("visual_identity") if isinstance(context, dict) else None
+
+
+def image_prompt(scene: str, visual_identity: Optional[Dict[str, Any]]) -> str:
+    """The DALL·E prompt: the scene plus, when present, the fixed brand visual identity."""
+    if not visual_identity:
+        return scene
+    parts = [scene, f"The brand hero: {visual_identity['mascot']}"]
+    if visual_identity.get("style"):
+        parts.append(f"Style: {visual_identity['style']}")
+    if visual_identity.get("palette"):
+        parts.append(f"Palette: {', '.join(visual_identity['palette'])}")
+    return "\n\n".join(parts)
+
+
+async def describe_scene(context_json: str) -> str:
+    # Parse the enriched context that includes both post content and company data
+    scene_agent = "SceneDescTool"
+    try:
+        context = json.loads(context_json)
+        content = context.get("content", "")
+        company_data = context.get("company_data", {})
+        brand_hero = company_data.get("brand_hero", "")
+        
+        if context.get("visual_identity"):
+            # The mascot comes from the identity pack - only the scene is left to describe
+            scene_agent = "SceneOnlyTool"
+            enriched_prompt = (
+                f"Post content: {content}\n"
+                f"Company context: {company_data.get('company_context', {})}"
+            )
+        else:
+            # Create an enriched prompt for the scene description
+            enriched_prompt = (
+                f"Post content: {content}\n"
+                f"Company context: {company_data.get('company_context', {})}\n"
+                f"Brand hero/mascot: {brand_hero}\n"
+                f"Create a vivid scene description incorporating the brand hero."
+            )
+        
+        logger.info(f"Generating scene description with enriched context")
+    except json.JSONDecodeError:
+        # Fallback if the input isn't valid JSON - treat it as simple content
+        logger.warning(f"Invalid JSON input to scene_description, using as plain text")
+        enriched_prompt = context_json
+    
+    res = await Runner.run(get_agent(scene_agent), enriched_prompt)
     try:
         obj = json.loads(res.final_output)
-        return {"scene_description": obj.get("scene_description", "")}    
+        return obj.get("scene_description", "")
     except Exception:
-        # Fallback: wrap plain text
-        return {"scene_description": res.final_output.strip()}
+        # Fallback: plain text
+        return res.final_output.strip()
+
+
+@function_tool(
+    strict_mode=False,
+    name_override='scene_description',
+    description_override='Create a concise scene description for the image, incorporating the brand hero.'
+)
+async def scene_description(context_json: str) -> Dict[str, str]:
+    description = await describe_scene(context_json)
+    return {"scene_description": image_prompt(description, _visual_identity(context_json))}
 
 
 class ImageAgent:
-    def __init__(self):
+    def __init__(self, mode: str = IMAGE_AGENT_MODE):
+        if mode not in ("pipeline", "agent"):
+            raise ValueError(f"Unknown ImageAgent mode '{mode}', expected 'pipeline' or 'agent'")
+        self.mode = mode
         self.agent = Agent(
             name='ImageAgent',
             instructions=(
@@ -101,23 +168,42 @@ class ImageAgent:
                 '2) Use the generate_image tool on the returned description; '
                 '3) Return exactly a JSON dict with keys scene_description and image_url.'
             ),
-            tools=[scene_description, generate_image]
+            tools=[scene_description, generate_image],
+            model=agent_model("ImageAgent")
         )
 
-    async def run(self, context: str) -> Dict[str, str]:
+    async def run(self, context: str) -> ImageAgentOutput:
         # Context can now be either a simple string (backward compatibility) 
         # or a JSON string with content and company data
+        if self.mode == "agent":
+            return await self.run_agent(context)
+        return await self.run_pipeline(context)
+
+    async def run_pipeline(self, context: str) -> ImageAgentOutput:
+        # Fixed sequence: scene description -> DALL·E, no orchestrating model hop
+        description = await describe_scene(context)
+        prompt = image_prompt(description, _visual_identity(context)) if description else ""
+        image = await create_image(prompt) if prompt else {"image_url": ""}
+        return ImageAgentOutput(scene_description=description, image_url=image.get("image_url", ""))
+
+    async def run_agent(self, context: str) -> ImageAgentOutput:
         result = await Runner.run(self.agent, context)
         output = result.final_output
         try:
             out = json.loads(output)
-            return {
-                'scene_description': out.get('scene_description', ''),
-                'image_url': out.get('image_url', '')
-            }
+            return ImageAgentOutput(
+                scene_description=out.get('scene_description', ''),
+                image_url=out.get('image_url', '')
+            )
         except Exception:
             parts = output.splitlines()
-            return {
-                'scene_description': parts[0] if parts else '',
-                'image_url': parts[1] if len(parts) > 1 else ''
-            }
\ No newline at end of file
+            return ImageAgentOutput(
+                scene_description=parts[0] if parts else '',
+                image_url=parts[1] if len(parts) > 1 else ''
+            )
+
+
+# Shared instances (see app.agents.registry)
+register_agent("SceneDescTool", _build_scene_agent)
+register_agent("SceneOnlyTool", _build_scene_only_agent)
+register_agent("ImageAgent", ImageAgent)
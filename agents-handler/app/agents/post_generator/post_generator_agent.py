@@ -2,29 +2,53 @@ import json
 import logging
 from typing import List, Dict
 from agents import Agent, Runner, function_tool
-from pydantic import BaseModel, Field, ValidationError
+from pydantic import BaseModel, Field, field_validator
+from app.agents.registry import agent_model, get_agent, register_agent
 
 logger = logging.getLogger(__name__)
 
+# Limits are applied by truncating, so one overlong caption does not fail the whole batch
+MAX_CONTENT_CHARS = 150
+MAX_HASHTAGS = 5
+
 class Post(BaseModel):
-    content: str = Field(..., max_length=150, description="Engaging caption")
-    hashtags: List[str] = Field(..., max_items=5, description="Up to 5 hashtags")
+    content: str = Field(..., description="Engaging caption")
+    hashtags: List[str] = Field(..., description="Up to 5 hashtags")
     call_to_action: str = Field(..., description="Prompting phrase")
 
+    @field_validator("content", mode="before")
+    @classmethod
+    def _truncate_content(cls, value):
+        return value[:MAX_CONTENT_CHARS] if isinstance(value, str) else value
+
+    @field_validator("hashtags", mode="before")
+    @classmethod
+    def _limit_hashtags(cls, value):
+        return value[:MAX_HASHTAGS] if isinstance(value, list) else value
+
 class PostsOutput(BaseModel):
     posts: List[Post]
 
-@function_tool(
-    strict_mode=False,
-    name_override="generate_posts",
-    description_override=(
-        "Generate a JSON array of social-media post drafts based on "
-        "strategy, company_context, and brand_hero."
+
+def _build_post_proposer_agent() -> Agent:
+    return Agent(
+        name="PostProposerTool",
+        instructions=(
+            "You are PostProposerTool.\n"
+            "INPUT: a single JSON object with keys: strategy, company_context, brand_hero.\n"
+            "TASK: Create exactly 3 engaging social media posts.\n\n"
+            "Each post object must have exactly these keys:\n"
+            "  • content        – string, max 120 chars\n"
+            "  • hashtags       – array of 2–3 hashtag strings (without #)\n"
+            "  • call_to_action – string, max 20 chars\n\n"
+            "If you cannot fulfill the request, return an empty posts list."
+        ),
+        output_type=PostsOutput,
+        model=agent_model("PostProposerTool")
     )
-)
 
 
-async def generate_posts(raw_input: str) -> List[Dict]:
+async def draft_posts(raw_input: str) -> PostsOutput:
     # 1) Ensure raw_input is valid JSON for the agent
     try:
         json.loads(raw_input)
@@ -38,53 +62,24 @@ async def generate_posts(raw_input: str) -> List[Dict]:
         }
         payload = json.dumps(fallback)
 
-    # 2) Build the Agent with a strict prompt
-    agent = Agent(
-        name="PostProposerTool",
-        instructions=(
-            "You are PostProposerTool.\n"
-            "INPUT: a single JSON object with keys: strategy, company_context, brand_hero.\n"
-            "TASK: Create exactly 3 engaging social media posts.\n\n"
-            "Each post object must have exactly these keys:\n"
-            "  • content        – string, max 120 chars\n"
-            "  • hashtags       – array of 2–3 hashtag strings (without #)\n"
-            "  • call_to_action – string, max 20 chars\n\n"
-            "If you cannot fulfill the request, return an empty array: []\n"
-            "OUTPUT: **EXACTLY** a JSON array of post objects, with no extra text or markup."
-        )
-    )
+    # 2) Invoke the shared agent; the SDK enforces PostsOutput as structured output.
+    #    API and output errors propagate: a generic stub post is not a proposal
+    result = await Runner.run(get_agent("PostProposerTool"), payload)
+    return result.final_output
 
-    # 3) Invoke the agent
-    result = await Runner.run(agent, payload)
-    raw = result.final_output.strip()
-    logger.debug("Raw content_agent output: %r", raw)
 
-    # 4) Extract the JSON array from any surrounding text
-    m = re.search(r'(\[.*\])', raw, re.DOTALL)
-    json_text = m.group(1) if m else raw
-
-    # 5) Try strict JSON parse
-    try:
-        posts = json.loads(json_text)
-        if isinstance(posts, list):
-            return posts
-        logger.warning("Parsed JSON not a list, got %s", type(posts))
-    except json.JSONDecodeError as e:
-        logger.warning("json.loads failed: %s", e)
+@function_tool(
+    strict_mode=False,
+    name_override="generate_posts",
+    description_override=(
+        "Generate a JSON array of social-media post drafts based on "
+        "strategy, company_context, and brand_hero."
+    )
+)
+async def generate_posts(raw_input: str) -> List[Dict]:
+    output = await draft_posts(raw_input)
+    return [post.model_dump() for post in output.posts]
 
-    # 6) Try Python literal_eval
-    try:
-        posts = ast.literal_eval(json_text)
-        if isinstance(posts, list):
-            return posts
-        logger.warning("literal_eval did not yield a list, got %s", type(posts))
-    except Exception as e:
-        logger.error("ast.literal_eval failed: %s", e)
 
-    # 7) Ultimate fallback: single stub post
-    logger.error("generate_posts: all parsing attempts failed, returning stub")
-    return [{
-        "content": "Discover our latest innovations designed with you in mind!",
-        "hashtags": ["Innovation", "Solutions", "Quality"],
-        "call_to_action": "Learn more!"
-    }]
+# Shared instance (see app.agents.registry)
+register_agent("PostProposerTool", _build_post_proposer_agent)
@@ -1,11 +1,21 @@
 import os
 import json
+import asyncio
 import logging
-from typing import List, Dict, Any, Optional
-from pymongo import MongoClient
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
 from app.agents.post_generator.image_agent import ImageAgent
-from app.agents.post_generator.post_generator_agent import generate_posts
+from app.schemas import ImageAgentOutput
+from app.agents.registry import agent_model, get_agent
+from app.agents.streaming import agent_events, AgentEvent
+from app.agents.context_projection import project_context, dumps_compact
+from app.bhagents.visual_identity import get_visual_identity, prompt_identity
+from app.images.persistence import image_persistence
+from app.images.refs import set_image_ref, image_file_id
+from app.jobs.post_pool import POOL_FIELDS
+from app.agents.post_generator.post_generator_agent import generate_posts, draft_posts
 from app.company_context_agents.prompts import get_edit_agent_prompt
+from app.db.mongo import get_collection
+from app.db.doc_cache import company_context_cache
 from agents import function_tool, Agent, Runner, ModelSettings
 from dotenv import load_dotenv
 from bson.json_util import dumps, loads
@@ -19,19 +29,21 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ----------------------
-# MongoDB Setup
+# MongoDB Collections (shared client, see app.db.mongo)
 # ----------------------
-MONGODB_URI = os.getenv("MONGODB_URI")
-MONGODB_DB = os.getenv("MONGODB_DB", "brand-hero")
-mongo_client = MongoClient(MONGODB_URI)
-db = mongo_client[MONGODB_DB]
-# Collections for storing post edit conversations and posts
-post_edit_conversations = db["post_edit_conversations"]
-posts_collection = db["posts"]
+POST_EDIT_CONVERSATIONS = "post_edit_conversations"
+POSTS = "posts"
+
+# Per-request image generation limits
+IMAGE_CONCURRENCY = int(os.getenv("POST_IMAGE_CONCURRENCY", "3"))
+IMAGE_TIMEOUT_SECONDS = float(os.getenv("POST_IMAGE_TIMEOUT_SECONDS", "90"))
+
+# "direct" calls the drafting step with structured output; "agent" goes through ContentAgent
+CONTENT_AGENT_MODE = os.getenv("CONTENT_AGENT_MODE", "direct")
 
 
 async def fetch_company_data(company_id: str) -> Dict[str, Any]:
-    doc = db.company_context_memory.find_one({"company_id": company_id})
+    doc = await company_context_cache.get(company_id)
     if not doc:
         raise ValueError(f"Company '{company_id}' not found")
 
@@ -39,6 +51,17 @@ async def fetch_company_data(company_id: str) -> Dict[str, Any]:
     doc["_id"] = str(doc["_id"])
     return doc
 
+
+async def scene_context(company_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    What the image step needs about the company: the projected document and, once
+    built, the brand visual identity that fixes the mascot across every scene.
+    """
+    return {
+        "company_data": project_context("SceneDescTool", data),
+        "visual_identity": prompt_identity(await get_visual_identity(company_id))
+    }
+
 @function_tool
 async def update_post_content(post_data: str, updated_content: str) -> Dict[str, Any]:
     post = json.loads(post_data)
@@ -48,11 +71,11 @@ async def update_post_content(post_data: str, updated_content: str) -> Dict[str,
 @function_tool
 async def update_post_image(post_data: str, scene_description: str, company_id: str) -> Dict[str, Any]:
     post = json.loads(post_data)
-    company_data = await fetch_company_data(company_id)
-    image_agent = ImageAgent()
-    context = {"content": post.get("content",""), "scene_description": scene_description, "company_data": company_data}
-    img_out = await image_agent.run(json.dumps(context))
-    post.update({"scene_description": scene_description, "image_url": img_out.get("image_url",""), "company_id": company_id})
+    company = await scene_context(company_id, await fetch_company_data(company_id))
+    image_agent = get_agent("ImageAgent")
+    context = {"content": post.get("content",""), "scene_description": scene_description, **company}
+    img_out = await image_agent.run(dumps_compact(context))
+    post.update({"scene_description": scene_description, "image_url": img_out.image_url, "company_id": company_id})
     return post
 
 @function_tool
@@ -77,89 +100,205 @@ async def update_full_post(
     company_id: str
 ) -> Dict[str, Any]:
     post = json.loads(post_data)
-    company_data = await fetch_company_data(company_id)
-    image_agent = ImageAgent()
-    context = {"content": content, "scene_description": scene_description, "company_data": company_data}
-    img_out = await image_agent.run(json.dumps(context))
+    company = await scene_context(company_id, await fetch_company_data(company_id))
+    image_agent = get_agent("ImageAgent")
+    context = {"content": content, "scene_description": scene_description, **company}
+    img_out = await image_agent.run(dumps_compact(context))
     post.update({
         "content": content,
         "hashtags": hashtags,
         "call_to_action": call_to_action,
         "scene_description": scene_description,
-        "image_url": img_out.get("image_url",""),
+        "image_url": img_out.image_url,
         "company_id": company_id
     })
     return post
 
-@function_tool
-async def save_post(post_data: str) -> Dict[str, Any]:
-    post = json.loads(post_data)
+def _persist_image_in_background(post: Dict[str, Any]) -> None:
+    # Copy the expiring OpenAI image into GridFS without delaying the response. Only
+    # for saved posts: the copy is linked from the post document, and an unsaved
+    # post's copy would be served to nobody and collected as unreferenced
+    if post.get("post_id") and post.get("image_url"):
+        image_persistence.enqueue(post["post_id"], post["company_id"], post["image_url"], post.get("scene_description"))
+
+
+async def persist_post(post: Dict[str, Any]) -> Dict[str, Any]:
     if "post_id" not in post:
         post["post_id"] = str(bson.ObjectId())
     if "company_id" not in post:
         raise ValueError("company_id is required to save a post")
-    posts_collection.update_one({"post_id": post["post_id"]}, {"$set": post}, upsert=True)
+    # Prefer the stable GridFS link if the temporary image was already persisted
+    post["image_url"] = image_persistence.persisted_url(post.get("image_url")) or post.get("image_url", "")
+    for field in POOL_FIELDS:
+        post.pop(field, None)
+    # A saved proposal leaves the pool, so its cleanup never deletes it
+    await get_collection(POSTS).update_one(
+        {"post_id": post["post_id"]},
+        {"$set": post, "$unset": {field: "" for field in POOL_FIELDS}},
+        upsert=True
+    )
+    await set_image_ref(f"post:{post['post_id']}", post["image_url"])
+    if post["image_url"] and image_file_id(post["image_url"]) is None:
+        # Still the expiring OpenAI link (the copy may have finished in another worker):
+        # persisting again is cheap - GridFS dedupes by source URL - and rewrites this post
+        _persist_image_in_background(post)
     logger.info(f"Saved post_id={post['post_id']}")
     return {"success": True, "post": post}
 
 
+@function_tool
+async def save_post(post_data: str) -> Dict[str, Any]:
+    return await persist_post(json.loads(post_data))
+
+
 async def dynamic_instructions(wrapper, agent) -> str:
     cid = wrapper.context['company_id']
     return get_edit_agent_prompt(cid)
 
 
 class PostOrchestratorAgent:
-    def __init__(self):
+    def __init__(
+        self,
+        image_concurrency: int = IMAGE_CONCURRENCY,
+        image_timeout: float = IMAGE_TIMEOUT_SECONDS,
+        content_mode: str = CONTENT_AGENT_MODE
+    ):
+        if content_mode not in ("direct", "agent"):
+            raise ValueError(f"Unknown content mode '{content_mode}', expected 'direct' or 'agent'")
+        self.content_mode = content_mode
+        self.image_concurrency = max(1, image_concurrency)
+        self.image_timeout = image_timeout
         self.content_agent = Agent(
             name="ContentAgent",
             instructions=(
                 "You are ContentAgent. On receiving input, you MUST call the 'generate_posts' tool with the exact JSON input. "
                 "Do NOT generate drafts directly. Return exactly its JSON output."
             ),
-            tools=[generate_posts]
+            tools=[generate_posts],
+            model=agent_model("ContentAgent")
         )
-        self.image_agent = ImageAgent()
+        self.image_agent: ImageAgent = get_agent("ImageAgent")
         self.edit_agent = Agent(
             name="PostEditAgent",
             instructions=dynamic_instructions,
             tools=[update_post_content, update_post_image, update_post_hashtags, update_post_cta, update_full_post, save_post],
-            model="gpt-3.5-turbo",
+            model=agent_model("PostEditAgent"),
             model_settings=ModelSettings(tool_choice="auto")
         )
 
-    async def generate(self, company_id: str, save_to_db: bool = False) -> List[Dict[str, Any]]:
-        data = await fetch_company_data(company_id)
-        result = await Runner.run(self.content_agent, json.dumps(data))
+    async def generate(
+        self,
+        company_id: str,
+        save_to_db: bool = False,
+        db_fields: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Draft posts and attach their images. With `save_to_db`, each post is upserted
+        as soon as its image is ready, together with `db_fields` (stored, not returned).
+        """
+        scene, posts = await self._draft_posts(company_id)
+
+        # Run the image pipelines concurrently; a failed or slow image only empties its own post
+        semaphore = asyncio.Semaphore(self.image_concurrency)
+        await asyncio.gather(*(self._attach_image(post, scene, semaphore, save_to_db, db_fields) for post in posts))
+        return posts
+
+    async def generate_stream(self, company_id: str, save_to_db: bool = False) -> AsyncIterator[AgentEvent]:
+        """
+        Incremental generate: a "post" event per drafted post as soon as the texts are
+        ready (image fields still empty), then an "image" event per post as its image
+        finishes, in completion order, and a closing "done" event.
+        """
+        scene, posts = await self._draft_posts(company_id)
+        for post in posts:
+            yield "post", dict(post)
+
+        semaphore = asyncio.Semaphore(self.image_concurrency)
+        tasks = [asyncio.create_task(self._attach_image(post, scene, semaphore, save_to_db)) for post in posts]
         try:
-            drafts = json.loads(result.final_output.strip())
-        except json.JSONDecodeError:
-            logger.error("Invalid JSON from ContentAgent: %s", result.final_output)
-            drafts = []
-        proposals = []
-        for draft in (drafts if isinstance(drafts, list) else [drafts]):
-            if not draft.get("content"): continue
-            draft.setdefault("hashtags", ["#Innovation"])
-            draft.setdefault("call_to_action", "Learn more")
-            img_context = {"content": draft["content"], "company_data": data}
-            try:
-                img_out = await self.image_agent.run(json.dumps(img_context))
-            except Exception:
-                img_out = {"scene_description": "", "image_url": ""}
-            post = {
+            for next_done in asyncio.as_completed(tasks):
+                post = await next_done
+                yield "image", {
+                    "post_id": post["post_id"],
+                    "scene_description": post["scene_description"],
+                    "image_url": post["image_url"]
+                }
+        finally:
+            # The client went away: stop paying for images nobody will see
+            for task in tasks:
+                task.cancel()
+        yield "done", {"company_id": company_id, "count": len(posts)}
+
+    async def _draft_posts(self, company_id: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """
+        Draft the post texts. Returns the scene context shared by every post's image
+        (projected once, not per post) and the posts with empty image fields.
+        """
+        data = await fetch_company_data(company_id)
+        # A visual identity rebuild, if one is due, overlaps with drafting
+        drafts, scene = await asyncio.gather(
+            self._draft(project_context("PostProposerTool", data)),
+            scene_context(company_id, data)
+        )
+        drafts = [d for d in (drafts if isinstance(drafts, list) else [drafts]) if d.get("content")]
+        posts = [
+            {
                 "post_id": str(bson.ObjectId()),
                 "company_id": company_id,
                 "content": draft["content"],
-                "hashtags": draft["hashtags"],
-                "call_to_action": draft["call_to_action"],
-                "scene_description": img_out.get("scene_description",""),
-                "image_url": img_out.get("image_url","")
+                "hashtags": draft.get("hashtags", ["#Innovation"]),
+                "call_to_action": draft.get("call_to_action", "Learn more"),
+                "scene_description": "",
+                "image_url": ""
             }
-            if save_to_db:
-                posts_collection.update_one({"post_id": post["post_id"]}, {"$set": post}, upsert=True)
-            proposals.append(post)
-        return proposals
+            for draft in drafts
+        ]
+        return scene, posts
 
-    async def edit_post(
+    async def _attach_image(
+        self,
+        post: Dict[str, Any],
+        scene: Dict[str, Any],
+        semaphore: asyncio.Semaphore,
+        save_to_db: bool,
+        db_fields: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        img_out = await self._generate_image(post, scene, semaphore)
+        post["scene_description"] = img_out.scene_description
+        post["image_url"] = img_out.image_url
+        if save_to_db:
+            await get_collection(POSTS).update_one(
+                {"post_id": post["post_id"]},
+                {"$set": {**post, **(db_fields or {})}},
+                upsert=True
+            )
+            _persist_image_in_background(post)
+        return post
+
+    async def _draft(self, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if self.content_mode == "direct":
+            output = await draft_posts(dumps_compact(data))
+            return [post.model_dump() for post in output.posts]
+
+        result = await Runner.run(self.content_agent, dumps_compact(data))
+        try:
+            return json.loads(result.final_output.strip())
+        except json.JSONDecodeError:
+            logger.error("Invalid JSON from ContentAgent: %s", result.final_output)
+            return []
+
+    async def _generate_image(self, draft: Dict[str, Any], scene: Dict[str, Any], semaphore: asyncio.Semaphore) -> ImageAgentOutput:
+        img_context = {"content": draft["content"], **scene}
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(self.image_agent.run(dumps_compact(img_context)), timeout=self.image_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Image generation timed out after %ss for draft: %s", self.image_timeout, draft["content"][:50])
+            except Exception as e:
+                logger.error("Image generation failed for draft: %s", e)
+        return ImageAgentOutput()
+
+    async def _prepare_edit(
         self,
         post_data: Dict[str, Any],
         company_id: str,
@@ -171,27 +310,55 @@ class PostOrchestratorAgent:
         context = {"post_data": json.dumps(post_data), "company_id": company_id, "conversation_id": conversation_id}
 
         # Load previous conversation state
-        doc = post_edit_conversations.find_one({"conversation_id": conversation_id})
+        doc = await get_collection(POST_EDIT_CONVERSATIONS).find_one({"conversation_id": conversation_id})
         prev_id = doc.get("previous_response_id") if doc else None
 
         # Run the editing agent
         if prev_id and user_response:
-            result = await Runner.run(
-                self.edit_agent,
-                context=context,
-                previous_response_id=prev_id,
-                input=user_response
-            )
-        else:
-            result = await Runner.run(
-                self.edit_agent,
-                context=context,
-                input=""
-            )
+            return {
+                "starting_agent": self.edit_agent,
+                "context": context,
+                "previous_response_id": prev_id,
+                "input": user_response
+            }
+        return {"starting_agent": self.edit_agent, "context": context, "input": ""}
 
+    async def edit_post(
+        self,
+        post_data: Dict[str, Any],
+        company_id: str,
+        user_response: Optional[str] = None
+    ) -> Dict[str, Any]:
+        run_kwargs = await self._prepare_edit(post_data, company_id, user_response)
+        result = await Runner.run(**run_kwargs)
+        return await self._finish_edit(post_data, company_id, run_kwargs["context"]["conversation_id"], result)
+
+    async def stream_edit_post(
+        self,
+        post_data: Dict[str, Any],
+        company_id: str,
+        user_response: Optional[str] = None
+    ) -> AsyncIterator[AgentEvent]:
+        """
+        Same as edit_post, but yields token deltas and tool calls as they happen,
+        followed by a final "result" event carrying edit_post's return value.
+        """
+        run_kwargs = await self._prepare_edit(post_data, company_id, user_response)
+        result = Runner.run_streamed(**run_kwargs)
+        async for event in agent_events(result):
+            yield event
+        yield "result", await self._finish_edit(post_data, company_id, run_kwargs["context"]["conversation_id"], result)
+
+    async def _finish_edit(
+        self,
+        post_data: Dict[str, Any],
+        company_id: str,
+        conversation_id: str,
+        result
+    ) -> Dict[str, Any]:
         last_id = getattr(result, 'last_response_id', None)
         # Persist conversation state
-        post_edit_conversations.update_one(
+        await get_collection(POST_EDIT_CONVERSATIONS).update_one(
             {"conversation_id": conversation_id},
             {"$set": {"previous_response_id": last_id, "company_id": company_id, "post_data": post_data}},
             upsert=True
@@ -211,7 +378,7 @@ class PostOrchestratorAgent:
         ]):
             # Agent has returned a complete post structure; save and return it
             try:
-                saved = await save_post(json.dumps(output_json))
+                saved = await persist_post(output_json)
                 final_post = saved.get("post", output_json)
             except Exception as e:
                 logger.error("Error saving post: %s", e)
@@ -0,0 +1,58 @@
+import os
+import logging
+from typing import Any, Callable, Dict, Optional
+from dotenv import load_dotenv
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# ----------------------
+# Models per agent (None = SDK default model)
+# ----------------------
+AGENT_MODELS: Dict[str, Optional[str]] = {
+    "SceneDescTool": os.getenv("SCENE_AGENT_MODEL"),
+    "PostProposerTool": os.getenv("POST_PROPOSER_MODEL"),
+    "ImageAgent": os.getenv("IMAGE_AGENT_MODEL"),
+    "VisualIdentityTool": os.getenv("VISUAL_IDENTITY_MODEL"),
+    "ContentAgent": os.getenv("CONTENT_AGENT_MODEL"),
+    "PostEditAgent": os.getenv("POST_EDIT_AGENT_MODEL", "gpt-3.5-turbo"),
+    "SocialMediaStrategy": os.getenv("STRATEGY_AGENT_MODEL", "o4-mini"),
+    "BHContextCollector": os.getenv("BH_AGENT_MODEL", "o4-mini"),
+    "CompanyContextCollector": os.getenv("COMPANY_CONTEXT_AGENT_MODEL", "o4-mini"),
+}
+
+_factories: Dict[str, Callable[[], Any]] = {}
+_instances: Dict[str, Any] = {}
+
+
+def agent_model(name: str) -> Optional[str]:
+    """Model configured for the agent with the given name."""
+    return AGENT_MODELS.get(name)
+
+
+def register_agent(name: str, factory: Callable[[], Any]) -> None:
+    """
+    Register a factory for a shared agent instance.
+    Agents must be stateless: per-call data goes in through the run input or context.
+    """
+    _factories[name] = factory
+
+
+def get_agent(name: str) -> Any:
+    """
+    Return the shared instance for `name`, building it on first use.
+    """
+    instance = _instances.get(name)
+    if instance is None:
+        if name not in _factories:
+            raise KeyError(f"No agent registered under '{name}'")
+        instance = _factories[name]()
+        _instances[name] = instance
+    return instance
+
+
+def warm_up() -> None:
+    """Build every registered agent so no request pays the setup cost."""
+    for name in _factories:
+        get_agent(name)
+    logger.info("Agent registry warmed up: %s", ", ".join(sorted(_instances)))
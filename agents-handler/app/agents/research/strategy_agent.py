@@ -1,84 +1,121 @@
 # strategy_agent.py
 
 import os
+import re
 import json
+import asyncio
 import logging
-from typing import Any, Dict, List, Optional
-import httpx
-from pymongo import MongoClient
+from typing import Any, AsyncIterator, Dict, List, Optional
 from agents import Agent, Runner, function_tool, ModelSettings
-from openai import OpenAI
+from app.clients.http_client import get_http_client
+from app.clients.openai_client import get_openai_client
 from app.company_context_agents.prompts import get_strategy_agent_prompt
+from app.db.mongo import get_collection
+from app.db import research_cache
+from app.db.doc_cache import company_context_cache, strategy_cache
+from app.jobs.post_pool import post_pool
+from app.agents.registry import agent_model
+from app.agents.streaming import agent_events, AgentEvent
 # ——— Logging & Config ———
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
-MONGO_URI          = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
-MONGO_DB           = os.getenv("MONGODB_DB", "brand-hero")
-OPENAI_API_KEY     = os.getenv("OPENAI_API_KEY", "")
+PERPLEXITY_URL     = "https://api.perplexity.ai/chat/completions"
 
-mongo_client = MongoClient(MONGO_URI)
-mongo_db = mongo_client[MONGO_DB]
-# Conversation memory collection
-strategy_conversations = mongo_db["strategy_conversations"]
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+DEFAULT_TRENDS = ["Content marketing", "Social engagement", "Video content"]
+DEFAULT_NEWS   = [{"title": "Industry trends", "url": ""}]
 
-# ——— Function Tools ———
+# ——— Research helpers ———
 
-@function_tool
-async def fetch_trends(company_id: str) -> List[str]:
+async def load_company_context(company_id: str) -> Optional[Dict[str, Any]]:
     """
-    Fetch trending topics using Perplexity API based on company context.
-    Returns a list of trending topics.
+    Load the company_context sub-document once for all research queries.
+    Returns None if the company does not exist.
     """
-    logger.info(f"Fetching trends for company_id: {company_id}")
-    # Get company context
-    doc = mongo_db.company_context_memory.find_one(
-        {"company_id": company_id},
-        {"company_context": 1}
-    )
+    doc = await company_context_cache.get(company_id)
     if not doc:
         logger.warning(f"Company '{company_id}' not found")
-        return ["Content marketing", "Social engagement", "Video content"]
-    
-    context = json.dumps(doc.get("company_context", {}))
+        return None
+    return doc.get("company_context", {})
+
+
+async def ask_perplexity(prompt: str) -> str:
+    """Run a single Perplexity chat completion over the shared HTTP pool."""
+    resp = await get_http_client().post(
+        PERPLEXITY_URL,
+        headers={
+            "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
+            "Content-Type": "application/json"
+        },
+        json={
+            "model": "sonar",
+            "messages": [
+                {"role": "system", "content": "Be concise."},
+                {"role": "user", "content": prompt}
+            ]
+        }
+    )
+    resp.raise_for_status()
+    return resp.json()["choices"][0]["message"]["content"]
+
+
+def parse_numbered_list(content: str) -> List[str]:
+    items = re.findall(r'\d+\.\s*(.+)', content)
+    # Fallback to line splitting if regex didn't work
+    if not items:
+        items = [line.strip() for line in content.splitlines() if line.strip()]
+    return items
+
+
+async def _fetch_trends(company_context: Dict[str, Any]) -> List[str]:
+    context = json.dumps(company_context)
     prompt = f"List the top 10 social media trends related to: {context}\nFormat as a numbered list."
-    
+    trends = parse_numbered_list(await ask_perplexity(prompt))
+    if not trends:
+        raise ValueError("Perplexity returned no trends")
+    # Return trends (max 10)
+    return trends[:10]
+
+
+async def _fetch_news(company_context: Dict[str, Any]) -> List[Dict[str, str]]:
+    context = json.dumps(company_context)
+    prompt = f"Provide 5 recent news headlines related to: {context}\nFormat as a numbered list."
+    headlines = parse_numbered_list(await ask_perplexity(prompt))
+    if not headlines:
+        raise ValueError("Perplexity returned no headlines")
+    return [{"title": headline, "url": ""} for headline in headlines[:5]]
+
+
+async def research_trends(company_context: Dict[str, Any]) -> List[str]:
+    # Served from the research cache; fallbacks are returned but never cached
     try:
-        # Call Perplexity API
-        async with httpx.AsyncClient(timeout=20) as client:
-            resp = await client.post(
-                "https://api.perplexity.ai/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "sonar",
-                    "messages": [
-                        {"role": "system", "content": "Be concise."},
-                        {"role": "user", "content": prompt}
-                    ]
-                }
-            )
-            resp.raise_for_status()
-            content = resp.json()["choices"][0]["message"]["content"]
-        
-        # Parse numbered list
-        import re
-        trends = re.findall(r'\d+\.\s*(.+)', content)
-        
-        # Fallback to line splitting if regex didn't work
-        if not trends:
-            trends = [line.strip() for line in content.splitlines() if line.strip()]
-            
-        # Return trends (max 10)
-        return trends[:10] if trends else ["Content marketing", "Social engagement", "Video content"]
-        
+        return await research_cache.get_or_fetch("trends", company_context, lambda: _fetch_trends(company_context))
     except Exception as e:
         logger.error(f"Error fetching trends: {str(e)}")
-        return ["Content marketing", "Social engagement", "Video content"]
+        return DEFAULT_TRENDS
+
+
+async def research_news(company_context: Dict[str, Any]) -> List[Dict[str, str]]:
+    try:
+        return await research_cache.get_or_fetch("news", company_context, lambda: _fetch_news(company_context))
+    except Exception as e:
+        logger.error(f"Error fetching news: {str(e)}")
+        return DEFAULT_NEWS
+
+# ——— Function Tools ———
+
+@function_tool
+async def fetch_trends(company_id: str) -> List[str]:
+    """
+    Fetch trending topics using Perplexity API based on company context.
+    Returns a list of trending topics.
+    """
+    logger.info(f"Fetching trends for company_id: {company_id}")
+    company_context = await load_company_context(company_id)
+    if company_context is None:
+        return DEFAULT_TRENDS
+    return await research_trends(company_context)
 
 
 @function_tool
@@ -87,53 +124,28 @@ async def fetch_news(company_id: str) -> List[Dict[str, str]]:
     Fetch news headlines using Perplexity API based on company context.
     Returns a list of news items.
     """
-    # Get company context
-    doc = mongo_db.company_context_memory.find_one(
-        {"company_id": company_id},
-        {"company_context": 1}
+    company_context = await load_company_context(company_id)
+    if company_context is None:
+        return DEFAULT_NEWS
+    return await research_news(company_context)
+
+
+@function_tool
+async def fetch_research(company_id: str) -> Dict[str, Any]:
+    """
+    Fetch both trending topics and news headlines for the company in one step.
+    Reads the company context once and runs both Perplexity queries concurrently.
+    Returns {"trends": [...], "news": [...]}.
+    """
+    logger.info(f"Fetching research for company_id: {company_id}")
+    company_context = await load_company_context(company_id)
+    if company_context is None:
+        return {"trends": DEFAULT_TRENDS, "news": DEFAULT_NEWS}
+    trends, news = await asyncio.gather(
+        research_trends(company_context),
+        research_news(company_context)
     )
-    if not doc:
-        logger.warning(f"Company '{company_id}' not found")
-        return [{"title": "Industry trends", "url": ""}]
-    
-    context = json.dumps(doc.get("company_context", {}))
-    prompt = f"Provide 5 recent news headlines related to: {context}\nFormat as a numbered list."
-    
-    try:
-        # Call Perplexity API
-        async with httpx.AsyncClient(timeout=20) as client:
-            resp = await client.post(
-                "https://api.perplexity.ai/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "sonar",
-                    "messages": [
-                        {"role": "system", "content": "Be concise."},
-                        {"role": "user", "content": prompt}
-                    ]
-                }
-            )
-            resp.raise_for_status()
-            content = resp.json()["choices"][0]["message"]["content"]
-        
-        # Parse numbered list
-        import re
-        headlines = re.findall(r'\d+\.\s*(.+)', content)
-        
-        # Fallback to line splitting if regex didn't work
-        if not headlines:
-            headlines = [line.strip() for line in content.splitlines() if line.strip()]
-            
-        # Convert to dictionaries
-        news = [{"title": headline, "url": ""} for headline in headlines[:5]]
-        return news if news else [{"title": "Industry trends", "url": ""}]
-        
-    except Exception as e:
-        logger.error(f"Error fetching news: {str(e)}")
-        return [{"title": "Industry trends", "url": ""}]
+    return {"trends": trends, "news": news}
 
 
 @function_tool
@@ -144,10 +156,7 @@ async def generate_strategy_proposal(company_id: str, trends: List[str], news: L
     """
     try:
         # Get company context
-        doc = mongo_db.company_context_memory.find_one(
-            {"company_id": company_id},
-            {"company_context": 1, "strategy_profile": 1}
-        )
+        doc = await company_context_cache.get(company_id)
         company_context = doc.get("company_context", {}) if doc else {}
         existing_strategy = doc.get("strategy_profile", {}) if doc else {}
         
@@ -164,7 +173,7 @@ async def generate_strategy_proposal(company_id: str, trends: List[str], news: L
         """
         
         # Call OpenAI
-        response = openai_client.chat.completions.create(
+        response = await get_openai_client().chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "You are a social media strategist. Return only valid JSON."},
@@ -178,7 +187,6 @@ async def generate_strategy_proposal(company_id: str, trends: List[str], news: L
             parsed = json.loads(content)
             return json.dumps(parsed)
         except json.JSONDecodeError:
-            import re
             match = re.search(r'\{.*\}', content, re.DOTALL)
             if match:
                 return match.group(0)
@@ -214,11 +222,14 @@ async def save_strategy(company_id: str, strategy_json: str) -> str:
         strategy = json.loads(strategy_json)
         
         # Update MongoDB
-        result = mongo_db.strategies.update_one(
+        result = await get_collection("strategies").update_one(
             {"company_id": company_id},
             {"$set": {"strategy": strategy}},
             upsert=True
         )
+        await strategy_cache.touch(company_id)
+        # Pooled post proposals were made for the previous strategy
+        post_pool.request_refill(company_id)
         
         return json.dumps({
             "success": True,
@@ -248,41 +259,37 @@ class StrategyAgent:
         self.agent = Agent(
             name="SocialMediaStrategy",
             instructions=dynamic_instructions,
-            model="o4-mini",
-            tools=[fetch_trends, fetch_news, generate_strategy_proposal, save_strategy],
+            model=agent_model("SocialMediaStrategy"),
+            tools=[fetch_research, fetch_trends, fetch_news, generate_strategy_proposal, save_strategy],
             model_settings=ModelSettings(tool_choice="auto")
         )
 
-    async def run(self, company_id: str, user_response: Optional[str] = None) -> Dict[str, Any]:
+    async def _prepare(self, company_id: str, user_response: Optional[str] = None) -> Dict[str, Any]:
         # Always use the passed company_id from the request
         context = {"company_id": company_id}
         logger.info(f"Runninng strategy agent for context={context}")
 
         # Retrieve any previous conversation state
-        doc = strategy_conversations.find_one({"company_id": company_id})
+        doc = await get_collection("strategy_conversations").find_one({"company_id": company_id})
         prev_id = doc.get("previous_response_id") if doc else None
 
         # Determine whether to continue or start fresh
         if user_response and prev_id:
             logger.info(f"Continuing strategy conversation for company_id={company_id}")
-            result = await Runner.run(
-                self.agent,
-                context=context,
-                previous_response_id=prev_id,
-                input=user_response
-            )
-        else:
-            logger.info(f"Starting initial strategy for company_id={company_id}")
-            result = await Runner.run(
-                self.agent,
-                context=context,
-                input=""
-            )
+            return {
+                "starting_agent": self.agent,
+                "context": context,
+                "previous_response_id": prev_id,
+                "input": user_response
+            }
+        logger.info(f"Starting initial strategy for company_id={company_id}")
+        return {"starting_agent": self.agent, "context": context, "input": ""}
 
+    async def _finish(self, company_id: str, result) -> Dict[str, Any]:
         # Extract new conversation ID for persistence
         last_id = getattr(result, 'last_response_id', None)
         if last_id:
-            strategy_conversations.update_one(
+            await get_collection("strategy_conversations").update_one(
                 {"company_id": company_id},
                 {"$set": {"previous_response_id": last_id}},
                 upsert=True
@@ -296,6 +303,20 @@ class StrategyAgent:
             "conversation_id": last_id
         }
 
+    async def run(self, company_id: str, user_response: Optional[str] = None) -> Dict[str, Any]:
+        result = await Runner.run(**await self._prepare(company_id, user_response))
+        return await self._finish(company_id, result)
+
+    async def stream(self, company_id: str, user_response: Optional[str] = None) -> AsyncIterator[AgentEvent]:
+        """
+        Same as run, but yields token deltas and tool calls as they happen,
+        followed by a final "result" event carrying run's return value.
+        """
+        result = Runner.run_streamed(**await self._prepare(company_id, user_response))
+        async for event in agent_events(result):
+            yield event
+        yield "result", await self._finish(company_id, result)
+
 # Expose agent and runner for api.py
 agent_instance = StrategyAgent()
 agent = agent_instance.agent
@@ -311,7 +332,7 @@ async def get_strategy_by_company_id(company_id: str):
     """
     try:
         # Query MongoDB for the strategy
-        strategy_doc = mongo_db.strategies.find_one({"company_id": company_id})
+        strategy_doc = await strategy_cache.get(company_id)
         
         if not strategy_doc:
             return {"error": f"No strategy found for company_id: {company_id}"}, 404
@@ -0,0 +1,91 @@
+import json
+import logging
+from typing import Any, AsyncIterator, Tuple
+from fastapi.responses import StreamingResponse
+from openai.types.responses import ResponseTextDeltaEvent
+from agents.result import RunResultStreaming
+
+logger = logging.getLogger(__name__)
+
+# (event name, payload) pairs sent to the client as SSE
+AgentEvent = Tuple[str, Any]
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    # Stop nginx from buffering the stream
+    "X-Accel-Buffering": "no",
+}
+
+
+def _field(raw: Any, name: str) -> Any:
+    # Run items wrap either SDK models or plain dicts
+    return raw.get(name) if isinstance(raw, dict) else getattr(raw, name, None)
+
+
+async def agent_events(result: RunResultStreaming) -> AsyncIterator[AgentEvent]:
+    """
+    Translate the SDK stream into token deltas, tool call start / finish and agent
+    handoffs. The run is cancelled if the consumer goes away before it finishes.
+    """
+    try:
+        async for event in result.stream_events():
+            if event.type == "raw_response_event":
+                if isinstance(event.data, ResponseTextDeltaEvent) and event.data.delta:
+                    yield "delta", {"text": event.data.delta}
+            elif event.type == "run_item_stream_event":
+                raw = event.item.raw_item
+                if event.name == "tool_called":
+                    yield "tool_call", {"tool": _field(raw, "name"), "call_id": _field(raw, "call_id")}
+                elif event.name == "tool_output":
+                    yield "tool_result", {"call_id": _field(raw, "call_id")}
+            elif event.type == "agent_updated_stream_event":
+                yield "agent", {"name": event.new_agent.name}
+    finally:
+        if not result.is_complete:
+            result.cancel()
+
+
+def _jsonable(value: Any) -> Any:
+    if hasattr(value, "model_dump"):
+        return value.model_dump()
+    return str(value)
+
+
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=_jsonable, ensure_ascii=False)}\n\n"
+
+
+async def _sse(events: AsyncIterator[AgentEvent]) -> AsyncIterator[str]:
+    try:
+        async for event, data in events:
+            yield sse_event(event, data)
+    except ValueError as e:
+        yield sse_event("error", {"status_code": 404, "detail": str(e)})
+    except Exception as e:
+        logger.exception("Streaming agent run failed: %s", e)
+        yield sse_event("error", {"status_code": 500, "detail": str(e)})
+
+
+def sse_response(events: AsyncIterator[AgentEvent]) -> StreamingResponse:
+    """
+    Stream agent events as Server-Sent Events. Errors after the first byte can no
+    longer change the status code, so they are reported as an `error` event.
+    """
+    return StreamingResponse(_sse(events), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+async def _ndjson(events: AsyncIterator[AgentEvent]) -> AsyncIterator[str]:
+    try:
+        async for event, data in events:
+            yield json.dumps({"event": event, "data": data}, default=_jsonable, ensure_ascii=False) + "\n"
+    except ValueError as e:
+        yield json.dumps({"event": "error", "data": {"status_code": 404, "detail": str(e)}}) + "\n"
+    except Exception as e:
+        logger.exception("Streaming run failed: %s", e)
+        yield json.dumps({"event": "error", "data": {"status_code": 500, "detail": str(e)}}) + "\n"
+
+
+def ndjson_response(events: AsyncIterator[AgentEvent]) -> StreamingResponse:
+    """Same events as sse_response, one {"event": ..., "data": ...} JSON object per line."""
+    return StreamingResponse(_ndjson(events), media_type="application/x-ndjson", headers=SSE_HEADERS)
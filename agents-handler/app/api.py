@@ -1,23 +1,31 @@
 import os
 import logging
-from openai import OpenAI
 from dotenv import load_dotenv
-from fastapi import APIRouter, FastAPI, HTTPException
-from typing import List
-from app.schemas import GeneratePostsRequest, PostProposal, CompanyContextRequest, StrategyRequest, PostEditRequest, StrategyResponse,CompanyContextResponse, BrandHeroContextRequest, BrandHeroContextResponse
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from typing import List, Optional
+from app.schemas import GeneratePostsRequest, PostProposal, CompanyContextRequest, StrategyRequest, PostEditRequest, StrategyResponse,CompanyContextResponse, BrandHeroContextRequest, BrandHeroContextResponse, JobResponse
 from app.agents.post_generator.post_orchestrator import PostOrchestratorAgent
-from app.agents.research.strategy_agent import StrategyAgent, mongo_db, get_strategy_by_company_id  # Import the StrategyAgent, mongo_db and get_strategy_by_company_id
-from app.db.company_context_db import get_company_context, get_brandhero_context, retrieve_image_from_gridfs
+from app.agents.research.strategy_agent import StrategyAgent, get_strategy_by_company_id  # Import the StrategyAgent and get_strategy_by_company_id
+from app.db.company_context_db import get_company_context, get_brandhero_context, open_image_from_gridfs
+from app.db.mongo import connect_mongo, close_mongo
+from app.db.indexes import ensure_indexes, report_indexes
+from app.db.doc_cache import start_cache_invalidation, stop_cache_invalidation, cache_status
+from app.agents.registry import warm_up as warm_up_agents
+from app.clients.openai_client import configure_openai, close_openai_client
+from app.clients.http_client import close_http_client
+from app.images.streaming import build_image_response
+from app.images.persistence import image_persistence
+from app.images.variants import find_variant, start_variant_pool, shutdown_variant_pool
+from app.images.refs import start_image_gc, stop_image_gc
+from app.jobs.queue import job_queue, JobNotFound, FINISHED
+from app.jobs.post_pool import post_pool
+from app.agents.streaming import sse_response, ndjson_response
+from app.db.singleflight import run_once, locked_stream
 
 import importlib.util
 import sys
 import os
-import gridfs
-from pymongo import MongoClient
-from bson.objectid import ObjectId
-from fastapi.responses import StreamingResponse
-import io
-from openai import OpenAI
+from contextlib import asynccontextmanager
 
 # Dynamic import for agent and runner from app/company-context-agents/context_agent.py
 context_agent_path = os.path.join(os.path.dirname(__file__), "company_context_agents", "context_agent.py")
@@ -28,6 +36,7 @@ spec.loader.exec_module(context_agent)
 agent = context_agent.agent
 runner = context_agent.runner
 run_company_context_agent_wrapper = context_agent.run_company_context_agent
+context_agent_instance = context_agent.agent_instance
 
 bh_agent_path = os.path.join(os.path.dirname(__file__), "bhagents", "bh_agent.py")
 spec_bh = importlib.util.spec_from_file_location("bh_agent", bh_agent_path)
@@ -37,6 +46,7 @@ spec_bh.loader.exec_module(bh_agent)
 agentbh = bh_agent.agent
 runnerbh = bh_agent.runner
 run_run_bh_agent_wrapper = bh_agent.run_bh_agent
+bh_agent_instance = bh_agent.agent_instance
 
 
 # Load .env at module import
@@ -47,30 +57,32 @@ load_dotenv(dotenv_path)
 router = APIRouter()
 postAgent = PostOrchestratorAgent()
 
-client = OpenAI()
-
-MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
-mongo_client = MongoClient(MONGODB_URI)
-mongo_db_name="brand-hero"
-mongo_db = mongo_client[os.getenv("MONGODB_DB", mongo_db_name)]
-collection_name="images"
-client = MongoClient(MONGODB_URI)
-db = client[mongo_db_name]
-fs = gridfs.GridFS(db)
-
-
 # Initialize the strategy agent
 strategyAgent = StrategyAgent()
 
-app = FastAPI()
-app.include_router(router, prefix='/api')
- 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-client = OpenAI()
-client.api_key = os.getenv("OPENAI_API_KEY")
+async def _posts_job(company_id: str, params: dict):
+    return await run_once("posts", company_id, None, lambda: postAgent.generate(company_id), exclusive=False)
+
+async def _brand_hero_job(company_id: str, params: dict):
+    user_response = params.get("user_response")
+    result = await run_once(
+        "brand_hero_context", company_id, user_response,
+        lambda: run_run_bh_agent_wrapper(agentbh, company_id, user_response)
+    )
+    return {"company_id": company_id, "result": result}
+
+async def _strategy_job(company_id: str, params: dict):
+    user_response = params.get("user_response")
+    result = await run_once("strategy", company_id, user_response, lambda: strategyAgent.run(company_id, user_response))
+    return {"company_id": company_id, "result": result}
+
+job_queue.register("posts", _posts_job)
+job_queue.register("brand_hero_context", _brand_hero_job)
+job_queue.register("strategy", _strategy_job)
 
  
 @router.get("/posts/{company_id}", response_model=List[PostProposal])
@@ -78,25 +90,55 @@ async def get_posts(company_id: str):
     """
     Generate 3/5/7 social-media posts for the given company_id.
     All inputs (strategy, tone, mascot) are fetched from MongoDB.
+    Proposals come from the pre-generated pool; only an empty pool runs the pipeline here.
     """
     try:
-        proposals = await postAgent.generate(company_id)
+        proposals = await post_pool.take(company_id)
+        if proposals:
+            return proposals
+        # Identical concurrent requests (double clicks, two tabs) share one run
+        proposals = await run_once("posts", company_id, None, lambda: postAgent.generate(company_id), exclusive=False)
         return proposals
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/posts/{company_id}/stream")
+async def stream_posts(company_id: str, format: str = "sse"):
+    """
+    Stream post generation: a `post` event per drafted post (image fields empty),
+    an `image` event per post once its scene description and image are ready, then `done`.
+    `format` selects Server-Sent Events (sse, default) or newline-delimited JSON (ndjson).
+    """
+    if format not in ("sse", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'sse' or 'ndjson'")
+    events = postAgent.generate_stream(company_id)
+    return sse_response(events) if format == "sse" else ndjson_response(events)
+
 @router.post('/company-context/{company_id}')
 async def run_company_context_agent(company_id: str, request: CompanyContextRequest = None):
     try:
         # Przekazujemy odpowiedź użytkownika, jeśli istnieje
         user_response = request.user_response if request and request.user_response else None
-        result = await run_company_context_agent_wrapper(agent, company_id, user_response)
+        result = await run_once(
+            "company_context", company_id, user_response,
+            lambda: run_company_context_agent_wrapper(agent, company_id, user_response)
+        )
         
         return {"company_id": company_id, "result": result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
  
 
+@router.post('/company-context/{company_id}/stream')
+async def stream_company_context_agent(company_id: str, request: CompanyContextRequest = None):
+    """
+    Streaming variant of POST /company-context/{company_id}: Server-Sent Events with
+    `delta`, `tool_call`, `tool_result` and a final `result` (or `error`) event.
+    """
+    user_response = request.user_response if request and request.user_response else None
+    return sse_response(locked_stream(company_id, context_agent_instance.stream(company_id, user_response)))
+
+
 @router.get('/company-context/{company_id}', response_model=CompanyContextResponse)
 async def get_company_context_endpoint(company_id: str):
     try:
@@ -122,12 +164,23 @@ async def run_brand_hero_context_agent(company_id: str, request: BrandHeroContex
     try:
         # Przekazujemy odpowiedź użytkownika, jeśli istnieje
         user_response = request.user_response if request and request.user_response else None
-        result = await run_run_bh_agent_wrapper(agentbh, company_id, user_response)
+        result = await run_once(
+            "brand_hero_context", company_id, user_response,
+            lambda: run_run_bh_agent_wrapper(agentbh, company_id, user_response)
+        )
 
         return {"company_id": company_id, "result": result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post('/brand-hero-context/{company_id}/stream')
+async def stream_brand_hero_context_agent(company_id: str, request: BrandHeroContextRequest = None):
+    """
+    Streaming variant of POST /brand-hero-context/{company_id} (Server-Sent Events).
+    """
+    user_response = request.user_response if request and request.user_response else None
+    return sse_response(locked_stream(company_id, bh_agent_instance.stream(company_id, user_response)))
+
 @router.get('/brand-hero-context/{company_id}', response_model=BrandHeroContextResponse)
 async def get_brand_hero_context_endpoint(company_id: str):
     try:
@@ -161,14 +214,62 @@ async def get_brand_hero_context_endpoint(company_id: str):
 
 
 
+@router.get("/indexes/status")
+async def get_index_status():
+    """
+    Required MongoDB indexes that are missing and existing indexes that have never been used.
+    """
+    return await report_indexes()
+
+
+@router.get("/post-pool/status")
+async def get_post_pool_status():
+    """
+    Counters of the per-worker post proposal pool (served, misses, generated, discarded).
+    """
+    return post_pool.status()
+
+@router.post("/post-pool/{company_id}")
+async def enroll_post_pool(company_id: str):
+    """
+    Opt a company into pre-generated post proposals. Companies are otherwise enrolled
+    only by taking proposals from their pool, so one-off visitors cost no background runs.
+    """
+    await post_pool.enroll(company_id)
+    return {"company_id": company_id, "enrolled": True}
+
+@router.get("/cache/status")
+async def get_cache_status():
+    """
+    Hit/miss counters of the per-worker document cache and its invalidation mode.
+    """
+    return cache_status()
+
+
+@router.get("/images/persistence/status")
+async def get_image_persistence_status():
+    """
+    Progress of the background worker pool copying generated images into GridFS.
+    """
+    return image_persistence.progress()
+
+
 @router.get("/images/{file_id}")
-async def get_image(file_id: str):
-    image_data, content_type = await retrieve_image_from_gridfs(file_id)
+async def get_image(file_id: str, request: Request, variant: Optional[str] = None, format: Optional[str] = None):
+    """
+    Stream an image from GridFS chunk by chunk.
+    Supports Range requests, ETag / If-None-Match (304) and long-lived caching.
+    `variant` (thumb, medium, full) and `format` (avif, webp, jpeg) or the Accept
+    header select a pre-rendered variant; the original is served when none exists.
+    """
+    accept = request.headers.get("accept")
+    variant_id = await find_variant(file_id, variant, accept, format)
+    grid_out, content_type = await open_image_from_gridfs(variant_id or file_id)
 
-    if not image_data:
+    if grid_out is None:
         raise HTTPException(status_code=404, detail=f"Image with ID {file_id} not found")
 
-    return StreamingResponse(io.BytesIO(image_data), media_type=content_type)
+    return build_image_response(grid_out, request, content_type, extra_headers={"Vary": "Accept"})
 
 
 
@@ -183,7 +284,7 @@ async def run_strategy_agent(company_id: str, request: StrategyRequest = None):
         user_response = request.user_response if request and request.user_response else None
         
         # Update the strategyAgent to accept user responses
-        result = await strategyAgent.run(company_id, user_response)
+        result = await run_once("strategy", company_id, user_response, lambda: strategyAgent.run(company_id, user_response))
         
         return {"company_id": company_id, "result": result}
     except ValueError as e:
@@ -193,6 +294,28 @@ async def run_strategy_agent(company_id: str, request: StrategyRequest = None):
         logger.exception(f"Strategy generation failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Strategy generation failed: {str(e)}")
     
+@router.post("/strategy/{company_id}/stream")
+async def stream_strategy_agent(company_id: str, request: StrategyRequest = None):
+    """
+    Streaming variant of POST /strategy/{company_id} (Server-Sent Events).
+    """
+    user_response = request.user_response if request and request.user_response else None
+    return sse_response(locked_stream(company_id, strategyAgent.stream(company_id, user_response)))
+
+@router.post("/posts/edit/stream")
+async def stream_edit_post(request: PostEditRequest):
+    """
+    Streaming variant of POST /posts/edit (Server-Sent Events).
+    """
+    post_data = request.post
+    if request.conversation_id:
+        post_data["conversation_id"] = request.conversation_id
+    return sse_response(locked_stream(request.company_id, postAgent.stream_edit_post(
+        post_data=post_data,
+        company_id=request.company_id,
+        user_response=request.user_response
+    )))
+
 @router.post("/posts/edit")
 async def edit_post(request: PostEditRequest):
     try:
@@ -204,10 +327,13 @@ async def edit_post(request: PostEditRequest):
             post_data["conversation_id"] = request.conversation_id
         
         # Call the edit_post method on the PostOrchestratorAgent with company_id
-        result = await postAgent.edit_post(
-            post_data=post_data, 
-            company_id=request.company_id,
-            user_response=request.user_response
+        result = await run_once(
+            "post_edit", request.company_id, {"post": post_data, "user_response": request.user_response},
+            lambda: postAgent.edit_post(
+                post_data=post_data, 
+                company_id=request.company_id,
+                user_response=request.user_response
+            )
         )
         
         return {
@@ -222,6 +348,50 @@ async def edit_post(request: PostEditRequest):
         logger.exception(f"Post edit failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Post edit failed: {str(e)}")
 
+@router.post("/jobs/posts/{company_id}", response_model=JobResponse, status_code=202)
+async def submit_posts_job(company_id: str):
+    """
+    Queue post generation and return at once; poll GET /jobs/{job_id} for progress.
+    """
+    return await job_queue.submit("posts", company_id)
+
+@router.post("/jobs/brand-hero-context/{company_id}", response_model=JobResponse, status_code=202)
+async def submit_brand_hero_job(company_id: str, request: BrandHeroContextRequest = None):
+    user_response = request.user_response if request and request.user_response else None
+    return await job_queue.submit("brand_hero_context", company_id, {"user_response": user_response})
+
+@router.post("/jobs/strategy/{company_id}", response_model=JobResponse, status_code=202)
+async def submit_strategy_job(company_id: str, request: StrategyRequest = None):
+    user_response = request.user_response if request and request.user_response else None
+    return await job_queue.submit("strategy", company_id, {"user_response": user_response})
+
+@router.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    try:
+        return await job_queue.get(job_id)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+@router.get("/jobs/{job_id}/result", response_model=JobResponse)
+async def get_job_result(job_id: str):
+    """
+    Final job state including its result; 409 while the job is still queued or running.
+    """
+    try:
+        job = await job_queue.get(job_id, include_result=True)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    if job["status"] not in FINISHED:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is still {job['status']}")
+    return job
+
+@router.delete("/jobs/{job_id}", response_model=JobResponse)
+async def cancel_job(job_id: str):
+    try:
+        return await job_queue.cancel(job_id)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
 @router.get("/strategy/{company_id}", response_model=StrategyResponse)
 async def get_strategy(company_id: str):
     """
@@ -247,5 +417,38 @@ async def get_strategy(company_id: str):
         logger.exception(f"Error fetching strategy: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching strategy: {str(e)}")
 
-app = FastAPI()
-app.include_router(router, prefix='/api')
\ No newline at end of file
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One shared MongoDB client (and connection pool) per worker
+    await connect_mongo()
+    # Required indexes for every collection; missing ones are logged, not fatal
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        logger.error(f"Could not ensure indexes: {str(e)}")
+    # Per-worker document cache, kept coherent by a change stream (or version polling)
+    start_cache_invalidation()
+    configure_openai()
+    # Build the shared agent instances before the first request
+    warm_up_agents()
+    start_variant_pool()
+    await image_persistence.start()
+    start_image_gc()
+    await job_queue.start()
+    # Pre-generated proposals for GET /posts; pooled posts are saved so their images persist
+    await post_pool.start(lambda company_id, fields: postAgent.generate(company_id, save_to_db=True, db_fields=fields))
+    yield
+    await post_pool.stop()
+    await job_queue.stop()
+    await stop_cache_invalidation()
+    await stop_image_gc()
+    await image_persistence.stop()
+    shutdown_variant_pool()
+    await close_openai_client()
+    await close_http_client()
+    close_mongo()
+
+
+app = FastAPI(lifespan=lifespan)
+app.include_router(router, prefix='/api')
@@ -1,16 +1,24 @@
 from agents import Agent, Runner, function_tool, ModelSettings
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, AsyncIterator
 import os
 import logging
 import datetime
 from app.bhagents.prompts import get_brand_hero_prompt
-from openai import OpenAI
+from app.agents.registry import agent_model
+from app.agents.streaming import agent_events, AgentEvent
+from app.clients.openai_client import get_openai_client
 from app.db.company_context_db import (
     get_company_context, 
     get_brandhero_context, 
     update_brandhero_context,
-    store_image_in_gridfs
+    update_and_get_brandhero_context,
+    get_image_sha256,
+    set_image_description
 )
+from app.db.memo import memoize
+from app.images.ingest import ingest_image
+from app.images.refs import set_image_ref
+from app.bhagents.visual_identity import refresh_visual_identity
 
 logger = logging.getLogger(__name__)
 
@@ -35,43 +43,83 @@ async def store_context(company_id: str, context_description: str) -> None:
         logger.error(f"Error saving brand hero context to MongoDB: {str(e)}")
         raise
 
-@function_tool
-async def generate_brand_hero(company_id: str) -> str:
+BRAND_HERO_TEXT_MODEL = "gpt-4.1"
+
+BRAND_HERO_VISION_PROMPT = "Prepare a very detailed description of the character in the image for me. I want the description to accurately reflect both the external appearance and the character traits of the figure. Remember that the description should allow for the exact recreation of the original image's style. I want to use the description to create additional images of this character performing different activities."
+
+async def _enhance_prompt(brandhero_context: str) -> str:
+    """
+    Zamienia kontekst brand hero w prompt do DALL-E. Wynik jest zapamiętywany
+    po skrócie wiadomości, więc regeneracja bez zmiany kontekstu go nie powtarza.
+    """
+    messages = [
+        {"role": "system", "content": "Jesteś pomocnikiem tworzącym wysokiej jakości prompty do DALL·E 3. Ulepszaj opisy postaci, dodając szczegóły dotyczące wyglądu, emocji, otoczenia, kompozycji i stylu graficznego."},
+        {"role": "system", "content": "A brand hero is a personification of a brand – a character (real or fictional) that represents the brand's values, personality, and way of communicating with its audience. The brand hero acts as the 'face of the brand' and can appear in advertisements, on packaging, websites, and social media. Its main goal is to build emotional connections with customers, strengthen brand recognition, and make the brand stand out from the competition."},
+        {"role": "system", "content": "Good brand hero should be simple. Should be easy to use in all forms of advertisements."},
+        {"role": "system", "content": "Reduce details."},
+        {"role": "system", "content": f"Generate detailed prompt for DALL·E to generate image of brand hero described as: {brandhero_context}"}
+    ]
+
+    async def enhance() -> str:
+        gpt_response = await get_openai_client().chat.completions.create(
+            model=BRAND_HERO_TEXT_MODEL,
+            messages=messages
+        )
+        return gpt_response.choices[0].message.content
+
+    return await memoize("brandhero_prompt", {"model": BRAND_HERO_TEXT_MODEL, "messages": messages}, enhance)
+
+async def _describe_image(image_url: str, image_sha256: Optional[str]) -> str:
+    """
+    Opisuje postać z obrazu modelem z obsługą obrazów. Opis jest zapamiętywany po
+    skrócie treści obrazu; bez skrótu (obraz nie trafił do GridFS) zawsze liczony od nowa.
+    """
+    async def describe() -> str:
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": BRAND_HERO_VISION_PROMPT},
+                    {"type": "image_url", "image_url": {"url": image_url}}
+                ]
+            }
+        ]
+        gpt_response = await get_openai_client().chat.completions.create(
+            model=BRAND_HERO_TEXT_MODEL,
+            messages=messages,
+            max_tokens=1000
+        )
+        return gpt_response.choices[0].message.content
+
+    if not image_sha256:
+        return await describe()
+    inputs = {"model": BRAND_HERO_TEXT_MODEL, "prompt": BRAND_HERO_VISION_PROMPT, "image_sha256": image_sha256}
+    return await memoize("brandhero_vision", inputs, describe)
+
+async def create_brand_hero(company_id: str, doc: Optional[Dict[str, Any]] = None) -> str:
     """
     Generuje obraz brand hero, analizuje go i zapisuje w bazie MongoDB.
     Zwraca szczegółowy opis wygenerowanego obrazu.
+    `doc` to już wczytany dokument brand hero - podany, oszczędza odczyt z bazy.
     """
     try:
-        # Pobierz aktualny kontekst brand hero
-        doc = await get_brandhero_context(company_id)
+        # Pobierz aktualny kontekst brand hero, jeśli wywołujący go nie ma
+        if doc is None:
+            doc = await get_brandhero_context(company_id)
         
         if not doc or "brandhero_context" not in doc:
             logger.error(f"No brand hero context found for company_id={company_id}")
             return "Nie znaleziono kontekstu brand hero. Najpierw zapisz kontekst używając store_context."
         
         brandhero_context = doc["brandhero_context"]
-        previous_response_id = doc.get("previous_response_id")
-        
-        # Generuj prompt do DALL-E
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         
-        # Generuj prompt do DALL-E
-        messages = [
-            {"role": "system", "content": "Jesteś pomocnikiem tworzącym wysokiej jakości prompty do DALL·E 3. Ulepszaj opisy postaci, dodając szczegóły dotyczące wyglądu, emocji, otoczenia, kompozycji i stylu graficznego."},
-            {"role": "system", "content": "A brand hero is a personification of a brand – a character (real or fictional) that represents the brand's values, personality, and way of communicating with its audience. The brand hero acts as the 'face of the brand' and can appear in advertisements, on packaging, websites, and social media. Its main goal is to build emotional connections with customers, strengthen brand recognition, and make the brand stand out from the competition."},
-            {"role": "system", "content": "Good brand hero should be simple. Should be easy to use in all forms of advertisements."},
-            {"role": "system", "content": "Reduce details."},
-            {"role": "system", "content": f"Generate detailed prompt for DALL·E to generate image of brand hero described as: {brandhero_context}"}
-        ]
+        client = get_openai_client()
         
-        gpt_response = client.chat.completions.create(
-            model="gpt-4.1",
-            messages=messages
-        )
-        dalle_prompt = gpt_response.choices[0].message.content
+        # Generuj prompt do DALL-E (ten sam kontekst = prompt z pamięci)
+        dalle_prompt = await _enhance_prompt(brandhero_context)
         
         # Generuj obraz
-        image_response = client.images.generate(
+        image_response = await client.images.generate(
             model="dall-e-3",
             prompt=dalle_prompt,
             size="1024x1024",
@@ -81,46 +129,22 @@ async def generate_brand_hero(company_id: str) -> str:
         
         image_url = image_response.data[0].url
         
-        # Generuj szczegółowy opis obrazu
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Prepare a very detailed description of the character in the image for me. I want the description to accurately reflect both the external appearance and the character traits of the figure. Remember that the description should allow for the exact recreation of the original image's style. I want to use the description to create additional images of this character performing different activities."
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": image_url
-                        }
-                    }
-                ]
-            }
-        ]
-        
-        gpt_response = client.chat.completions.create(
-            model="gpt-4.1",
-            messages=messages,
-            max_tokens=1000
-        )
-        
-        brandhero_description = gpt_response.choices[0].message.content
-        
-        # Zapisz obraz w GridFS
-        success, file_id, image_base64 = await store_image_in_gridfs(
+        # Zapisz obraz w GridFS - skrót treści pliku jest kluczem opisu obrazu
+        success, file_id = await ingest_image(
             image_url=image_url,
-            company_id=company_id,
-            description=brandhero_description
+            company_id=company_id
         )
+        image_sha256 = await get_image_sha256(file_id) if success and file_id else None
+        
+        # Generuj szczegółowy opis obrazu
+        brandhero_description = await _describe_image(image_url, image_sha256)
+        if success and file_id:
+            await set_image_description(file_id, brandhero_description)
         
         if success and file_id:
-            # Zapisz kontekst, opis i referencję do obrazu w MongoDB
+            # Zapisz opis i referencję do obrazu w MongoDB (kontekst się nie zmienił)
             db_success = await update_brandhero_context(
                 company_id=company_id,
-                brandhero_context=brandhero_context,
-                previous_response_id=previous_response_id,
                 brandhero_description=brandhero_description,
                 image_url=f"/api/images/{file_id}"  # URL do naszego endpointu
             )
@@ -129,6 +153,9 @@ async def generate_brand_hero(company_id: str) -> str:
                 logger.error(f"Failed to save brand hero context for company_id={company_id}")
                 return "Nie udało się zapisać kontekstu brand hero."
             
+            # Nowy opis brand hero - przebuduj pakiet tożsamości wizualnej
+            refresh_visual_identity(company_id)
+            await set_image_ref(f"brandhero:{company_id}", f"/api/images/{file_id}")
             logger.info(f"Generated and saved brand hero image and description for company_id={company_id}")
             
             # Return a detailed response with all the brand hero information
@@ -142,14 +169,13 @@ Brand Hero Description (based on generated image):
 Image URL: /api/images/{file_id}
 """
         else:
-            # Jeśli nie udało się zapisać obrazu, zapisz przynajmniej kontekst i opis z oryginalnym URL
+            # Jeśli nie udało się zapisać obrazu, zapisz przynajmniej opis z oryginalnym URL
             await update_brandhero_context(
                 company_id=company_id,
-                brandhero_context=brandhero_context,
-                previous_response_id=previous_response_id,
                 brandhero_description=brandhero_description,
                 image_url=image_url  # Oryginalny URL z OpenAI
             )
+            refresh_visual_identity(company_id)
             
             return f"Wygenerowano obraz brand hero, ale wystąpił błąd podczas zapisywania go w bazie danych. URL obrazu: {image_url}"
         
@@ -157,33 +183,33 @@ Image URL: /api/images/{file_id}
         logger.exception(f"Error generating brand hero: {str(e)}")
         return f"Wystąpił błąd podczas generowania brand hero: {str(e)}"
 
+@function_tool
+async def generate_brand_hero(company_id: str) -> str:
+    """
+    Generuje obraz brand hero, analizuje go i zapisuje w bazie MongoDB.
+    Zwraca szczegółowy opis wygenerowanego obrazu.
+    """
+    return await create_brand_hero(company_id)
+
 @function_tool
 async def update_brand_hero(company_id: str, updated_context: str) -> str:
     """
     Aktualizuje kontekst brand hero i regeneruje obraz na podstawie zaktualizowanego kontekstu.
     """
     try:
-        # Pobierz aktualny dokument, aby zachować previous_response_id
-        doc = await get_brandhero_context(company_id)
-        if not doc:
-            logger.error(f"No brand hero context found for company_id={company_id}")
-            return "Nie znaleziono kontekstu brand hero do aktualizacji."
-        
-        previous_response_id = doc.get("previous_response_id")
-        
-        # Zapisz zaktualizowany kontekst
-        success = await update_brandhero_context(
+        # Zapisz zaktualizowany kontekst i od razu dostań cały dokument
+        doc = await update_and_get_brandhero_context(
             company_id=company_id,
             brandhero_context=updated_context,
-            previous_response_id=previous_response_id
+            upsert=False
         )
         
-        if not success:
-            logger.error(f"Failed to update brand hero context for company_id={company_id}")
-            return "Nie udało się zaktualizować kontekstu brand hero."
+        if not doc:
+            logger.error(f"No brand hero context found for company_id={company_id}")
+            return "Nie znaleziono kontekstu brand hero do aktualizacji."
         
         # Regeneruj obraz na podstawie zaktualizowanego kontekstu
-        return await generate_brand_hero(company_id)
+        return await create_brand_hero(company_id, doc)
         
     except Exception as e:
         logger.exception(f"Error updating brand hero: {str(e)}")
@@ -195,32 +221,25 @@ async def update_brand_hero_image(company_id: str, updated_description: str) ->
     Aktualizuje opis brand hero i regeneruje obraz na podstawie zaktualizowanego opisu.
     """
     try:
-        # Pobierz aktualny dokument
-        doc = await get_brandhero_context(company_id)
+        # Zapisz zaktualizowany opis i od razu dostań kontekst z tego samego dokumentu
+        doc = await update_and_get_brandhero_context(
+            company_id=company_id,
+            brandhero_description=updated_description,
+            upsert=False
+        )
+        
         if not doc:
             logger.error(f"No brand hero context found for company_id={company_id}")
             return "Nie znaleziono kontekstu brand hero do aktualizacji."
         
+        refresh_visual_identity(company_id)
         brandhero_context = doc.get("brandhero_context", "")
-        previous_response_id = doc.get("previous_response_id")
-        
-        # Zapisz zaktualizowany opis
-        success = await update_brandhero_context(
-            company_id=company_id,
-            brandhero_context=brandhero_context,
-            previous_response_id=previous_response_id,
-            brandhero_description=updated_description
-        )
-        
-        if not success:
-            logger.error(f"Failed to update brand hero description for company_id={company_id}")
-            return "Nie udało się zaktualizować opisu brand hero."
         
         # Generuj nowy obraz na podstawie zaktualizowanego opisu
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = get_openai_client()
         
         # Generuj obraz
-        image_response = client.images.generate(
+        image_response = await client.images.generate(
             model="dall-e-3",
             prompt=updated_description,
             size="1024x1024",
@@ -231,7 +250,7 @@ async def update_brand_hero_image(company_id: str, updated_description: str) ->
         image_url = image_response.data[0].url
         
         # Zapisz obraz w GridFS
-        success, file_id, image_base64 = await store_image_in_gridfs(
+        success, file_id = await ingest_image(
             image_url=image_url,
             company_id=company_id,
             description=updated_description
@@ -241,9 +260,6 @@ async def update_brand_hero_image(company_id: str, updated_description: str) ->
             # Zaktualizuj referencję do obrazu w MongoDB
             db_success = await update_brandhero_context(
                 company_id=company_id,
-                brandhero_context=brandhero_context,
-                previous_response_id=previous_response_id,
-                brandhero_description=updated_description,
                 image_url=f"/api/images/{file_id}"  # URL do naszego endpointu
             )
             
@@ -251,6 +267,7 @@ async def update_brand_hero_image(company_id: str, updated_description: str) ->
                 logger.error(f"Failed to update brand hero image reference for company_id={company_id}")
                 return "Nie udało się zaktualizować referencji do obrazu brand hero."
             
+            await set_image_ref(f"brandhero:{company_id}", f"/api/images/{file_id}")
             logger.info(f"Updated brand hero image for company_id={company_id}")
             
             # Return a detailed response with all the brand hero information
@@ -300,7 +317,7 @@ class BranHeroContextAgent:
         self.agent = Agent(
             name="BHContextCollector",
             instructions=dynamic_instructions,
-            model="o4-mini",
+            model=agent_model("BHContextCollector"),
             tools=[
                 store_context, 
                 get_company_context_data, 
@@ -311,22 +328,15 @@ class BranHeroContextAgent:
             model_settings=ModelSettings(tool_choice="auto"),  # pozwól LLM decydować
         )
 
-    async def run(self, company_id: str, user_response: Optional[str] = None) -> Dict[str, Any]:
+    async def _prepare(self, company_id: str, user_response: Optional[str] = None) -> Dict[str, Any]:
         """
-        Uruchamia agenta zbierającego kontekst brand hero.
-
-        Args:
-            company_id: Identyfikator firmy
-            user_response: Opcjonalna odpowiedź użytkownika na pytanie agenta
-
-        Returns:
-            Słownik zawierający wynik działania agenta i identyfikator ostatniej odpowiedzi
+        Przygotowuje argumenty dla Runner.run / Runner.run_streamed.
         """
         # 1. Zbuduj kontekst dla agenta
         context = {"company_id": company_id}
 
-        # 2. Pobierz poprzedni identyfikator odpowiedzi i kontekst z MongoDB
-        doc = await get_brandhero_context(company_id)
+        # 2. Pobierz poprzedni identyfikator odpowiedzi i kontekst z MongoDB (z pominięciem cache)
+        doc = await get_brandhero_context(company_id, fresh=True)
         previous_response_id = doc.get("previous_response_id") if doc else None
         
         # 3. Check if we already have a complete brand hero context with description and image
@@ -342,45 +352,33 @@ Image URL: {doc['image_url']}
 """
             
             # Run the agent with this special message
-            result = await Runner.run(
-                self.agent,
-                context=context,
-                input=existing_context_message
-            )
+            return {"starting_agent": self.agent, "context": context, "input": existing_context_message}
         # 4. If we have a user response and previous_response_id, continue the conversation
         elif user_response and previous_response_id:
             # Uruchom agenta z kontekstem i odpowiedzią użytkownika
             logger.info(f"Running agent with user response for company {company_id}")
-            result = await Runner.run(
-                self.agent,
-                context=context,
-                previous_response_id=previous_response_id,
-                input=user_response
-            )
+            return {
+                "starting_agent": self.agent,
+                "context": context,
+                "previous_response_id": previous_response_id,
+                "input": user_response
+            }
         else:
             # Pierwsze uruchomienie - bez odpowiedzi użytkownika
             logger.info(f"Running agent for first time for company {company_id}")
-            result = await Runner.run(
-                self.agent,
-                context=context,
-                input=""
-            )
+            return {"starting_agent": self.agent, "context": context, "input": ""}
 
-        # 4. Wyciągnij nowy previous_response_id z wyniku (jeśli jest)
+    async def _finish(self, company_id: str, result) -> Dict[str, Any]:
+        """
+        Zapisuje stan rozmowy po zakończeniu przebiegu agenta.
+        """
+        # Wyciągnij nowy previous_response_id z wyniku (jeśli jest)
         last_response_id = getattr(result, 'last_response_id', None)
 
-        # 5. Zaktualizuj MongoDB, jeśli jest nowy previous_response_id
+        # Zaktualizuj MongoDB, jeśli jest nowy previous_response_id
         if last_response_id:
-            # Pobierz aktualny kontekst brand hero, jeśli istnieje
-            doc = await get_brandhero_context(company_id)
-            brandhero_context = doc.get("brandhero_context", "") if doc else ""
-            
-            # Aktualizuj dokument z nowym previous_response_id
-            await update_brandhero_context(
-                company_id=company_id,
-                brandhero_context=brandhero_context,
-                previous_response_id=last_response_id
-            )
+            # Zmieniamy tylko previous_response_id - kontekst mógł właśnie zapisać agent
+            await update_brandhero_context(company_id=company_id, previous_response_id=last_response_id)
             logger.info(f"Updated previous_response_id for company {company_id}")
 
         return {
@@ -388,6 +386,30 @@ Image URL: {doc['image_url']}
             "previous_response_id": last_response_id
         }
 
+    async def run(self, company_id: str, user_response: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Uruchamia agenta zbierającego kontekst brand hero.
+
+        Args:
+            company_id: Identyfikator firmy
+            user_response: Opcjonalna odpowiedź użytkownika na pytanie agenta
+
+        Returns:
+            Słownik zawierający wynik działania agenta i identyfikator ostatniej odpowiedzi
+        """
+        result = await Runner.run(**await self._prepare(company_id, user_response))
+        return await self._finish(company_id, result)
+
+    async def stream(self, company_id: str, user_response: Optional[str] = None) -> AsyncIterator[AgentEvent]:
+        """
+        Jak run, ale zwraca zdarzenia (tokeny, wywołania narzędzi) na bieżąco,
+        a na końcu zdarzenie "result" z tym samym wynikiem co run.
+        """
+        result = Runner.run_streamed(**await self._prepare(company_id, user_response))
+        async for event in agent_events(result):
+            yield event
+        yield "result", await self._finish(company_id, result)
+
 # Inicjalizacja agenta dla importu w api.py
 agent_instance = BranHeroContextAgent()
 agent = agent_instance.agent
@@ -0,0 +1,135 @@
+from typing import Any, Dict, List, Optional, Set
+import asyncio
+import json
+import logging
+import os
+from agents import Agent, Runner
+from pydantic import BaseModel, Field, field_validator
+from app.agents.registry import agent_model, get_agent, register_agent
+from app.db.lru import TTLCache
+from app.db.company_context_db import get_brandhero_context, get_company_context, store_visual_identity
+from app.db.research_cache import context_hash
+from app.db.singleflight import lease
+
+logger = logging.getLogger(__name__)
+
+# Pola pakietu, które trafiają do promptów (bez wersji, skrótu i daty budowy)
+PROMPT_FIELDS = ("mascot", "style", "palette")
+
+MAX_MASCOT_CHARS = 950
+MAX_PALETTE_COLORS = 6
+# Po nieudanej budowie te same dane źródłowe nie są ponawiane przez ten czas
+VISUAL_IDENTITY_RETRY_SECONDS = float(os.getenv("VISUAL_IDENTITY_RETRY_SECONDS", "900"))
+
+# company_id:source_hash -> True dla ostatnio nieudanych budów (per proces)
+_failed_builds = TTLCache(maxsize=1024, ttl=VISUAL_IDENTITY_RETRY_SECONDS)
+
+
+class VisualIdentity(BaseModel):
+    mascot: str = Field(..., max_length=MAX_MASCOT_CHARS, description="Canonical appearance of the brand hero")
+    style: str = Field(..., description="Illustration style shared by every image")
+    palette: List[str] = Field(..., max_length=MAX_PALETTE_COLORS, description="Brand colors")
+
+    # Za długi opis lub paleta są przycinane - nie warto tracić całej budowy
+    @field_validator("mascot", mode="before")
+    @classmethod
+    def _truncate_mascot(cls, value):
+        return value[:MAX_MASCOT_CHARS] if isinstance(value, str) else value
+
+    @field_validator("palette", mode="before")
+    @classmethod
+    def _limit_palette(cls, value):
+        return value[:MAX_PALETTE_COLORS] if isinstance(value, list) else value
+
+
+def _build_visual_identity_agent() -> Agent:
+    return Agent(
+        name="VisualIdentityTool",
+        instructions=(
+            "You are a brand art director preparing a reusable visual identity for image prompts.\n"
+            "INPUT: JSON with keys brandhero_description (detailed description of the brand hero image) "
+            "and company_context (what the company does, tone of voice, colors).\n"
+            "OUTPUT:\n"
+            "  • mascot  – one hyper-detailed paragraph, max 950 characters, describing only the brand hero's "
+            "fixed appearance (shape, proportions, colors, clothing, facial features) so every image renders the same character\n"
+            "  • style   – one sentence on the illustration style (cartoonish, bright and colorful unless the brand says otherwise)\n"
+            "  • palette – up to 6 brand colors as plain color names or hex codes\n"
+            "Do not describe any scene, pose or activity."
+        ),
+        output_type=VisualIdentity,
+        model=agent_model("VisualIdentityTool")
+    )
+
+
+def _identity_source(brandhero: Dict[str, Any], company: Dict[str, Any]) -> Dict[str, Any]:
+    # Wszystko, od czego zależy pakiet - zmiana któregokolwiek pola oznacza przebudowę
+    return {
+        "brandhero_description": brandhero.get("brandhero_description", ""),
+        "context_description": company.get("context_description", ""),
+        "company_context": company.get("company_context", {}),
+    }
+
+
+def prompt_identity(visual_identity: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Część pakietu przekazywana do promptów scen i obrazów.
+    """
+    if not visual_identity or not visual_identity.get("mascot"):
+        return None
+    return {k: visual_identity[k] for k in PROMPT_FIELDS if k in visual_identity}
+
+
+async def get_visual_identity(company_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Zwraca aktualny pakiet tożsamości wizualnej firmy, budując go tylko wtedy, gdy
+    opis brand hero albo kontekst firmy zmieniły się od ostatniej budowy.
+    None, jeśli firma nie ma jeszcze opisu brand hero albo budowa się nie powiodła.
+    """
+    brandhero = await get_brandhero_context(company_id)
+    if not brandhero or not brandhero.get("brandhero_description"):
+        return None
+    company = await get_company_context(company_id) or {}
+    source = _identity_source(brandhero, company)
+    source_hash = context_hash(source)
+
+    current = brandhero.get("visual_identity")
+    if current and current.get("source_hash") == source_hash:
+        return current
+    failure_key = f"{company_id}:{source_hash}"
+    if _failed_builds.get(failure_key):
+        # Niedawno się nie udało - bez kolejnego wywołania modelu przy każdej scenie
+        return current
+
+    try:
+        # Jedna budowa na firmę także między procesami
+        async with lease(f"visual_identity:{company_id}"):
+            brandhero = await get_brandhero_context(company_id, fresh=True)
+            current = (brandhero or {}).get("visual_identity")
+            if current and current.get("source_hash") == source_hash:
+                return current
+
+            logger.info(f"Building visual identity for company_id={company_id}")
+            result = await Runner.run(get_agent("VisualIdentityTool"), json.dumps(source, ensure_ascii=False, default=str))
+            return await store_visual_identity(company_id, result.final_output.model_dump(), source_hash)
+    except Exception as e:
+        logger.error(f"Error building visual identity for company_id={company_id}: {str(e)}")
+        _failed_builds.set(failure_key, True)
+        # Nieaktualny pakiet jest lepszy niż opisywanie maskotki od nowa w każdej scenie
+        return current
+
+
+_refresh_tasks: Set[asyncio.Task] = set()
+
+
+def refresh_visual_identity(company_id: str) -> None:
+    """
+    Przebudowuje pakiet w tle po zmianie opisu brand hero lub kontekstu firmy,
+    żeby pierwsze generowanie postów nie czekało na budowę.
+    """
+    task = asyncio.create_task(get_visual_identity(company_id))
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+# Współdzielona instancja (patrz app.agents.registry)
+register_agent("VisualIdentityTool", _build_visual_identity_agent)
@@ -0,0 +1 @@
+# This file makes the clients directory a Python package
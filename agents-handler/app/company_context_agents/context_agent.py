@@ -1,8 +1,12 @@
 from agents import Agent, Runner, function_tool, ModelSettings
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, AsyncIterator
 import logging
 from app.company_context_agents.prompts import get_company_context_prompt
+from app.agents.registry import agent_model
+from app.agents.streaming import agent_events, AgentEvent
 from app.db.company_context_db import update_company_context, get_company_context, get_initial_company_data
+from app.bhagents.visual_identity import refresh_visual_identity
+from app.jobs.post_pool import post_pool
 
 logger = logging.getLogger(__name__)
 
@@ -77,6 +81,9 @@ async def store_context(company_id: str, context_description: str) -> None:
             raise Exception(f"Failed to save context for company_id={company_id}")
             
         logger.info(f"Saved context for company_id={company_id} to MongoDB")
+        # Pakiet tożsamości wizualnej zależy od kontekstu firmy
+        refresh_visual_identity(company_id)
+        post_pool.request_refill(company_id)
     except Exception as e:
         logger.error(f"Error saving context to MongoDB: {str(e)}")
         raise
@@ -91,28 +98,20 @@ class CompanyContextAgent:
         self.agent = Agent(
             name="CompanyContextCollector",
             instructions=dynamic_instructions,
-            model="o4-mini",
+            model=agent_model("CompanyContextCollector"),
             tools=[get_initial_data_from_db, fetch_sql_db, store_context],
             model_settings=ModelSettings(tool_choice="auto"),  # pozwól LLM decydować
         )
 
-    async def run(self, company_id: str, user_response: Optional[str] = None) -> Dict[str, Any]:
+    async def _prepare(self, company_id: str, user_response: Optional[str] = None) -> Dict[str, Any]:
         """
-        Uruchamia agenta zbierającego kontekst firmy.
-        
-        Args:
-            company_id: Identyfikator firmy
-            user_response: Opcjonalna odpowiedź użytkownika na pytanie agenta
-            
-        Returns:
-            Słownik zawierający wynik działania agenta i identyfikator ostatniej odpowiedzi
+        Przygotowuje argumenty dla Runner.run / Runner.run_streamed.
         """
         # 1. Zbuduj kontekst dla agenta
         context = {"company_id": company_id}
         
-        # 2. Pobierz poprzedni identyfikator odpowiedzi i kontekst z MongoDB
-        from app.db.company_context_db import get_company_context
-        doc = await get_company_context(company_id)
+        # 2. Pobierz poprzedni identyfikator odpowiedzi i kontekst z MongoDB (z pominięciem cache)
+        doc = await get_company_context(company_id, fresh=True)
         previous_response_id = doc.get("previous_response_id") if doc else None
         
         # 3. Check if we already have a complete context
@@ -124,41 +123,33 @@ class CompanyContextAgent:
             existing_context_message = f"EXISTING_CONTEXT_DATA: {doc['context_description']}"
             
             # Run the agent with this special message
-            result = await Runner.run(
-                self.agent,
-                context=context,
-                input=existing_context_message
-            )
+            return {"starting_agent": self.agent, "context": context, "input": existing_context_message}
         # 4. If we have a user response and previous_response_id, continue the conversation
         elif user_response and previous_response_id:
             # Uruchom agenta z kontekstem i odpowiedzią użytkownika
             logger.info(f"Running agent with user response for company {company_id}")
-            result = await Runner.run(
-                self.agent,
-                context=context,
-                previous_response_id=previous_response_id,
-                input=user_response
-            )
+            return {
+                "starting_agent": self.agent,
+                "context": context,
+                "previous_response_id": previous_response_id,
+                "input": user_response
+            }
         else:
             # Pierwsze uruchomienie - bez odpowiedzi użytkownika
             logger.info(f"Running agent for first time for company {company_id}")
-            result = await Runner.run(
-                self.agent,
-                context=context,
-                input=""
-            )
+            return {"starting_agent": self.agent, "context": context, "input": ""}
 
-        # 4. Wyciągnij nowy previous_response_id z wyniku (jeśli jest)
+    async def _finish(self, company_id: str, result) -> Dict[str, Any]:
+        """
+        Zapisuje stan rozmowy po zakończeniu przebiegu agenta.
+        """
+        # Wyciągnij nowy previous_response_id z wyniku (jeśli jest)
         last_response_id = getattr(result, 'last_response_id', None)
 
-        # 5. Zaktualizuj MongoDB, jeśli jest nowy previous_response_id
+        # Zaktualizuj MongoDB, jeśli jest nowy previous_response_id
         if last_response_id:
-            # Pobierz aktualny kontekst, jeśli istnieje
-            doc = await get_company_context(company_id)
-            context_description = doc.get("context_description", "") if doc else ""
-            
-            # Aktualizuj dokument z nowym previous_response_id
-            await update_company_context(company_id, context_description, last_response_id)
+            # Zmieniamy tylko previous_response_id - opis mógł właśnie zapisać agent
+            await update_company_context(company_id, previous_response_id=last_response_id)
             logger.info(f"Updated previous_response_id for company {company_id}")
 
         return {
@@ -166,6 +157,30 @@ class CompanyContextAgent:
             "previous_response_id": last_response_id
         }
 
+    async def run(self, company_id: str, user_response: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Uruchamia agenta zbierającego kontekst firmy.
+        
+        Args:
+            company_id: Identyfikator firmy
+            user_response: Opcjonalna odpowiedź użytkownika na pytanie agenta
+            
+        Returns:
+            Słownik zawierający wynik działania agenta i identyfikator ostatniej odpowiedzi
+        """
+        result = await Runner.run(**await self._prepare(company_id, user_response))
+        return await self._finish(company_id, result)
+
+    async def stream(self, company_id: str, user_response: Optional[str] = None) -> AsyncIterator[AgentEvent]:
+        """
+        Jak run, ale zwraca zdarzenia (tokeny, wywołania narzędzi) na bieżąco,
+        a na końcu zdarzenie "result" z tym samym wynikiem co run.
+        """
+        result = Runner.run_streamed(**await self._prepare(company_id, user_response))
+        async for event in agent_events(result):
+            yield event
+        yield "result", await self._finish(company_id, result)
+
 # Inicjalizacja agenta dla importu w api.py
 agent_instance = CompanyContextAgent()
 agent = agent_instance.agent
@@ -1,21 +1,28 @@
 from typing import Optional, Dict, Any, Tuple
 import logging
-from pymongo import MongoClient
-import os
-import requests
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket, AsyncIOMotorGridOut
 import base64
-import gridfs
+import hashlib
+import os
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
+from app.db.mongo import get_collection, get_database
+from app.db.doc_cache import company_context_cache, brandhero_cache
+from app.clients.http_client import get_http_client
 
 logger = logging.getLogger(__name__)
 
-# MongoDB setup
-MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
-mongo_client = MongoClient(MONGODB_URI)
-mongo_db = mongo_client[os.getenv("MONGO_DB", "brand-hero")]
-company_context_collection = mongo_db["company_context_memory"]
-company_initial_collection = mongo_db["company_initial_memory"]
-company_brandhero_collection = mongo_db["company_brandhero_memory"]
+# Kolekcje MongoDB (klient współdzielony, patrz app.db.mongo)
+COMPANY_CONTEXT_COLLECTION = "company_context_memory"
+COMPANY_INITIAL_COLLECTION = "company_initial_memory"
+COMPANY_BRANDHERO_COLLECTION = "company_brandhero_memory"
+GRIDFS_FILES_COLLECTION = "fs.files"
+
+# Limity pobierania obrazów do GridFS
+IMAGE_DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT_SECONDS", "60"))
+IMAGE_DOWNLOAD_MAX_BYTES = int(os.getenv("IMAGE_DOWNLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+IMAGE_DOWNLOAD_CHUNK_BYTES = 255 * 1024  # rozmiar fragmentu GridFS
 
 async def get_initial_company_data(company_id: str) -> Optional[Dict[str, Any]]:
     """
@@ -29,7 +36,7 @@ async def get_initial_company_data(company_id: str) -> Optional[Dict[str, Any]]:
     """
     try:
         # Pobierz dokument z MongoDB
-        doc = company_initial_collection.find_one({"company_id": company_id})
+        doc = await get_collection(COMPANY_INITIAL_COLLECTION).find_one({"company_id": company_id})
         
         if not doc:
             logger.warning(f"Initial data for company_id {company_id} not found")
@@ -40,19 +47,19 @@ async def get_initial_company_data(company_id: str) -> Optional[Dict[str, Any]]:
         logger.error(f"Error retrieving initial company data from MongoDB: {str(e)}")
         return None
 
-async def get_company_context(company_id: str) -> Optional[Dict[str, Any]]:
+async def get_company_context(company_id: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
     """
-    Pobiera kontekst firmy z bazy MongoDB na podstawie company_id.
+    Pobiera kontekst firmy na podstawie company_id (przez cache procesu).
     
     Args:
         company_id: Identyfikator firmy
+        fresh: Pomiń cache i czytaj z MongoDB (np. dla stanu rozmowy)
         
     Returns:
         Słownik zawierający dane kontekstu firmy lub None, jeśli nie znaleziono
     """
     try:
-        # Pobierz dokument z MongoDB
-        doc = company_context_collection.find_one({"company_id": company_id})
+        doc = await company_context_cache.get(company_id, fresh=fresh)
         
         # Jeśli dokument nie istnieje lub nie ma context_description, zwróć None
         if not doc or "context_description" not in doc:
@@ -64,39 +71,41 @@ async def get_company_context(company_id: str) -> Optional[Dict[str, Any]]:
         logger.error(f"Error retrieving company context from MongoDB: {str(e)}")
         return None
 
-async def update_company_context(company_id: str, context_description: str, previous_response_id: Optional[str] = None) -> bool:
+def _partial_update(fields: Dict[str, Any], required: Tuple[str, ...]) -> Dict[str, Any]:
+    """
+    Buduje aktualizację zmieniającą tylko podane pola (None = bez zmian).
+    Wymagane pola, których nie podano, dostają "" tylko przy tworzeniu dokumentu.
+    """
+    update: Dict[str, Any] = {"$set": {k: v for k, v in fields.items() if v is not None}}
+    on_insert = {k: "" for k in required if fields.get(k) is None}
+    if on_insert:
+        update["$setOnInsert"] = on_insert
+    return update
+
+async def update_company_context(
+    company_id: str,
+    context_description: Optional[str] = None,
+    previous_response_id: Optional[str] = None
+) -> bool:
     """
-    Aktualizuje lub tworzy kontekst firmy w bazie MongoDB.
+    Aktualizuje lub tworzy kontekst firmy w bazie MongoDB jednym zapisem.
+    Zmieniane są tylko podane pola, więc nie trzeba wcześniej czytać dokumentu.
     
     Args:
         company_id: Identyfikator firmy
-        context_description: Opis kontekstu firmy
+        context_description: Opcjonalny nowy opis kontekstu firmy
         previous_response_id: Opcjonalny identyfikator poprzedniej odpowiedzi
         
     Returns:
         True jeśli operacja się powiodła, False w przeciwnym razie
     """
     try:
-        # Jeśli previous_response_id nie został podany, pobierz go z istniejącego dokumentu
-        if previous_response_id is None:
-            doc = company_context_collection.find_one({"company_id": company_id})
-            previous_response_id = doc.get("previous_response_id") if doc else None
-        
-        # Przygotuj dane do aktualizacji
-        update_data = {
-            "context_description": context_description
-        }
-        
-        # Dodaj previous_response_id, jeśli istnieje
-        if previous_response_id:
-            update_data["previous_response_id"] = previous_response_id
-        
-        # Aktualizacja lub utworzenie dokumentu
-        company_context_collection.update_one(
-            {"company_id": company_id},
-            {"$set": update_data},
-            upsert=True
+        update = _partial_update(
+            {"context_description": context_description, "previous_response_id": previous_response_id},
+            required=("context_description",)
         )
+        await get_collection(COMPANY_CONTEXT_COLLECTION).update_one({"company_id": company_id}, update, upsert=True)
+        await company_context_cache.touch(company_id)
         
         logger.info(f"Updated context for company_id={company_id} in MongoDB")
         return True
@@ -104,19 +113,19 @@ async def update_company_context(company_id: str, context_description: str, prev
         logger.error(f"Error updating company context in MongoDB: {str(e)}")
         return False
 
-async def get_brandhero_context(company_id: str) -> Optional[Dict[str, Any]]:
+async def get_brandhero_context(company_id: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
     """
-    Pobiera kontekst brand hero z bazy MongoDB na podstawie company_id.
+    Pobiera kontekst brand hero na podstawie company_id (przez cache procesu).
     
     Args:
         company_id: Identyfikator firmy
+        fresh: Pomiń cache i czytaj z MongoDB (np. dla stanu rozmowy)
         
     Returns:
         Słownik zawierający dane kontekstu brand hero lub None, jeśli nie znaleziono
     """
     try:
-        # Pobierz dokument z MongoDB
-        doc = company_brandhero_collection.find_one({"company_id": company_id})
+        doc = await brandhero_cache.get(company_id, fresh=fresh)
         
         # Jeśli dokument nie istnieje lub nie ma brandhero_context, zwróć None
         if not doc or "brandhero_context" not in doc:
@@ -132,72 +141,159 @@ async def store_image_in_gridfs(
     image_url: str,
     company_id: str,
     description: Optional[str] = None,
-    source: str = "brand_hero_generator"
+    source: str = "brand_hero_generator",
+    include_base64: bool = False,
+    filename: Optional[str] = None
 ) -> Tuple[bool, Optional[str], Optional[str]]:
     """
-    Pobiera obraz z URL, zapisuje go w GridFS i zwraca ID pliku oraz base64 obrazu.
+    Pobiera obraz z URL strumieniowo i zapisuje go w GridFS fragment po fragmencie,
+    bez trzymania całego obrazu w pamięci.
+    
+    Pliki są adresowane treścią (sha256 w metadata): ponowne pobranie tego samego URL
+    albo obrazu o identycznej treści zwraca istniejący plik zamiast tworzyć duplikat.
     
     Args:
         image_url: URL obrazu do pobrania
         company_id: Identyfikator firmy
         description: Opcjonalny opis obrazu
         source: Źródło obrazu (domyślnie "brand_hero_generator")
+        include_base64: Czy zwrócić obraz w formacie base64 (wymaga zbuforowania obrazu)
+        filename: Nazwa pliku w GridFS (domyślnie brand_hero_{company_id}.jpg)
         
     Returns:
         Tuple zawierający:
         - bool: True jeśli operacja się powiodła, False w przeciwnym razie
         - Optional[str]: ID pliku w GridFS lub None w przypadku błędu
-        - Optional[str]: Obraz w formacie base64 lub None w przypadku błędu
+        - Optional[str]: Obraz w formacie base64 (tylko gdy include_base64=True) lub None
     """
+    grid_in = None
     try:
         # Inicjalizacja GridFS
-        fs = gridfs.GridFS(mongo_db)
+        fs = AsyncIOMotorGridFSBucket(get_database())
         
-        # Pobierz obraz
-        response = requests.get(image_url)
-        if response.status_code != 200:
-            logger.error(f"Failed to download image from URL: {image_url}")
-            return False, None, None
+        # Ponowne pobranie tego samego URL nic nie kosztuje - plik już istnieje
+        existing = await get_collection(GRIDFS_FILES_COLLECTION).find_one({"metadata.source_url": image_url}, {"_id": 1})
+        if existing:
+            logger.info(f"Image from {image_url} already stored with ID: {existing['_id']}")
+            image_base64 = await _read_base64(fs, existing["_id"]) if include_base64 else None
+            return True, str(existing["_id"]), image_base64
         
-        image_data = response.content
-        
-        # Zapisz obraz w GridFS
-        metadata = {
-            "company_id": company_id,
-            "content_type": response.headers.get("Content-Type", "image/jpeg"),
-            "description": description,
-            "source": source
-        }
+        # Pobierz obraz strumieniowo przez współdzielonego klienta HTTP
+        async with get_http_client().stream("GET", image_url, timeout=IMAGE_DOWNLOAD_TIMEOUT_SECONDS) as response:
+            if response.status_code != 200:
+                logger.error(f"Failed to download image from URL: {image_url}")
+                return False, None, None
+            
+            declared_length = int(response.headers.get("Content-Length") or 0)
+            if declared_length > IMAGE_DOWNLOAD_MAX_BYTES:
+                logger.error(f"Image at {image_url} is too large ({declared_length} bytes)")
+                return False, None, None
+            
+            # Zapisz obraz w GridFS
+            metadata = {
+                "company_id": company_id,
+                "content_type": response.headers.get("Content-Type", "image/jpeg"),
+                "description": description,
+                "source": source,
+                "source_url": image_url
+            }
+            grid_in = fs.open_upload_stream(filename or f"brand_hero_{company_id}.jpg", metadata=metadata)
+            
+            size = 0
+            digest = hashlib.sha256()
+            buffered = bytearray() if include_base64 else None
+            async for chunk in response.aiter_bytes(IMAGE_DOWNLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > IMAGE_DOWNLOAD_MAX_BYTES:
+                    logger.error(f"Image at {image_url} exceeded {IMAGE_DOWNLOAD_MAX_BYTES} bytes, aborting")
+                    await grid_in.abort()
+                    return False, None, None
+                await grid_in.write(chunk)
+                digest.update(chunk)
+                if buffered is not None:
+                    buffered.extend(chunk)
+            
+            await grid_in.close()
         
-        file_id = fs.put(image_data, filename=f"brand_hero_{company_id}.jpg", metadata=metadata)
+        file_id = await _deduplicate(fs, grid_in._id, digest.hexdigest())
         
-        # Konwertuj obraz do base64
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
+        # Konwertuj obraz do base64 tylko na życzenie
+        image_base64 = base64.b64encode(bytes(buffered)).decode('utf-8') if buffered is not None else None
         
-        logger.info(f"Image stored in GridFS with ID: {file_id}")
+        logger.info(f"Image stored in GridFS with ID: {file_id} ({size} bytes)")
         return True, str(file_id), image_base64
     except Exception as e:
         logger.error(f"Error storing image in GridFS: {str(e)}")
+        if grid_in is not None and not grid_in.closed:
+            try:
+                await grid_in.abort()
+            except Exception:
+                pass
         return False, None, None
 
-async def retrieve_image_from_gridfs(file_id: str) -> Tuple[Optional[bytes], Optional[str]]:
+async def _deduplicate(fs: AsyncIOMotorGridFSBucket, file_id: ObjectId, sha256: str) -> ObjectId:
     """
-    Pobiera obraz z GridFS na podstawie ID pliku.
+    Oznacza nowy plik skrótem treści albo, jeśli identyczny plik już istnieje,
+    usuwa nowy i zwraca ID istniejącego. Unikalny indeks na metadata.sha256
+    rozstrzyga wyścig dwóch równoczesnych zapisów tej samej treści.
+    """
+    files = get_collection(GRIDFS_FILES_COLLECTION)
+    existing = await files.find_one({"metadata.sha256": sha256, "_id": {"$ne": file_id}}, {"_id": 1})
+    if existing is None:
+        try:
+            await files.update_one({"_id": file_id}, {"$set": {"metadata.sha256": sha256}})
+            return file_id
+        except DuplicateKeyError:
+            existing = await files.find_one({"metadata.sha256": sha256}, {"_id": 1})
+    await fs.delete(file_id)
+    logger.info(f"Image content already stored as {existing['_id']}, dropped duplicate {file_id}")
+    return existing["_id"]
+
+async def _read_base64(fs: AsyncIOMotorGridFSBucket, file_id: ObjectId) -> str:
+    grid_out = await fs.open_download_stream(file_id)
+    return base64.b64encode(await grid_out.read()).decode('utf-8')
+
+async def get_image_sha256(file_id: str) -> Optional[str]:
+    """
+    Zwraca skrót treści (sha256) obrazu z GridFS lub None, jeśli plik go nie ma.
+    """
+    try:
+        doc = await get_collection(GRIDFS_FILES_COLLECTION).find_one({"_id": ObjectId(file_id)}, {"metadata.sha256": 1})
+        return ((doc or {}).get("metadata") or {}).get("sha256")
+    except Exception as e:
+        logger.error(f"Error reading image hash from GridFS: {str(e)}")
+        return None
+
+async def set_image_description(file_id: str, description: str) -> None:
+    """
+    Uzupełnia opis obrazu w metadanych GridFS (gdy powstaje dopiero po zapisaniu pliku).
+    """
+    try:
+        await get_collection(GRIDFS_FILES_COLLECTION).update_one(
+            {"_id": ObjectId(file_id)},
+            {"$set": {"metadata.description": description}}
+        )
+    except Exception as e:
+        logger.error(f"Error updating image description in GridFS: {str(e)}")
+
+async def open_image_from_gridfs(file_id: str) -> Tuple[Optional[AsyncIOMotorGridOut], Optional[str]]:
+    """
+    Otwiera strumień odczytu obrazu z GridFS bez wczytywania go do pamięci.
     
     Args:
         file_id: ID pliku w GridFS
         
     Returns:
         Tuple zawierający:
-        - Optional[bytes]: Dane obrazu lub None w przypadku błędu
+        - Optional[AsyncIOMotorGridOut]: Otwarty plik GridFS lub None, jeśli nie istnieje
         - Optional[str]: Typ zawartości (content type) lub None w przypadku błędu
     """
     try:
         # Inicjalizacja GridFS
-        fs = gridfs.GridFS(mongo_db)
+        fs = AsyncIOMotorGridFSBucket(get_database())
         
-        # Pobierz obraz
-        grid_out = fs.get(ObjectId(file_id))
+        # Otwórz strumień (pobiera tylko dokument pliku, nie dane)
+        grid_out = await fs.open_download_stream(ObjectId(file_id))
         
         # Pobierz typ zawartości z metadanych
         content_type = None
@@ -206,24 +302,63 @@ async def retrieve_image_from_gridfs(file_id: str) -> Tuple[Optional[bytes], Opt
         else:
             content_type = 'image/jpeg'
         
-        return grid_out.read(), content_type
+        return grid_out, content_type
+    except Exception as e:
+        logger.error(f"Error opening image from GridFS: {str(e)}")
+        return None, None
+
+async def retrieve_image_from_gridfs(file_id: str) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    Pobiera cały obraz z GridFS na podstawie ID pliku.
+    Do serwowania obrazów przez HTTP używaj open_image_from_gridfs (strumieniowo).
+    
+    Args:
+        file_id: ID pliku w GridFS
+        
+    Returns:
+        Tuple zawierający:
+        - Optional[bytes]: Dane obrazu lub None w przypadku błędu
+        - Optional[str]: Typ zawartości (content type) lub None w przypadku błędu
+    """
+    grid_out, content_type = await open_image_from_gridfs(file_id)
+    if grid_out is None:
+        return None, None
+    try:
+        return await grid_out.read(), content_type
     except Exception as e:
         logger.error(f"Error retrieving image from GridFS: {str(e)}")
         return None, None
 
+def _brandhero_update(
+    brandhero_context: Optional[str],
+    previous_response_id: Optional[str],
+    brandhero_description: Optional[str],
+    image_url: Optional[str]
+) -> Dict[str, Any]:
+    return _partial_update(
+        {
+            "brandhero_context": brandhero_context,
+            "previous_response_id": previous_response_id,
+            "brandhero_description": brandhero_description,
+            "image_url": image_url
+        },
+        required=("brandhero_context",)
+    )
+
 async def update_brandhero_context(
     company_id: str, 
-    brandhero_context: str, 
+    brandhero_context: Optional[str] = None, 
     previous_response_id: Optional[str] = None,
     brandhero_description: Optional[str] = None,
     image_url: Optional[str] = None
 ) -> bool:
     """
-    Aktualizuje lub tworzy kontekst brand hero w bazie MongoDB.
+    Aktualizuje lub tworzy kontekst brand hero w bazie MongoDB jednym zapisem.
+    Zmieniane są tylko podane pola, więc nie trzeba wcześniej czytać dokumentu.
     
     Args:
         company_id: Identyfikator firmy
-        brandhero_context: Opis kontekstu brand hero
+        brandhero_context: Opcjonalny nowy opis kontekstu brand hero
         previous_response_id: Opcjonalny identyfikator poprzedniej odpowiedzi
         brandhero_description: Opcjonalny szczegółowy opis brand hero na podstawie wygenerowanego obrazu
         image_url: Opcjonalny URL do wygenerowanego obrazu brand hero
@@ -232,35 +367,75 @@ async def update_brandhero_context(
         True jeśli operacja się powiodła, False w przeciwnym razie
     """
     try:
-        # Jeśli previous_response_id nie został podany, pobierz go z istniejącego dokumentu
-        if previous_response_id is None:
-            doc = company_brandhero_collection.find_one({"company_id": company_id})
-            previous_response_id = doc.get("previous_response_id") if doc else None
+        update = _brandhero_update(brandhero_context, previous_response_id, brandhero_description, image_url)
+        await get_collection(COMPANY_BRANDHERO_COLLECTION).update_one({"company_id": company_id}, update, upsert=True)
+        await brandhero_cache.touch(company_id)
         
-        # Przygotuj dane do aktualizacji
-        update_data = {
-            "brandhero_context": brandhero_context,
-        }
-        
-        # Dodaj opcjonalne pola, jeśli istnieją
-        if previous_response_id:
-            update_data["previous_response_id"] = previous_response_id
-        
-        if brandhero_description:
-            update_data["brandhero_description"] = brandhero_description
-            
-        if image_url:
-            update_data["image_url"] = image_url
-        
-        # Aktualizacja lub utworzenie dokumentu
-        company_brandhero_collection.update_one(
+        logger.info(f"Updated brand hero context for company_id={company_id} in MongoDB")
+        return True
+    except Exception as e:
+        logger.error(f"Error updating brand hero context in MongoDB: {str(e)}")
+        return False
+
+async def update_and_get_brandhero_context(
+    company_id: str, 
+    brandhero_context: Optional[str] = None, 
+    previous_response_id: Optional[str] = None,
+    brandhero_description: Optional[str] = None,
+    image_url: Optional[str] = None,
+    upsert: bool = True
+) -> Optional[Dict[str, Any]]:
+    """
+    Jak update_brandhero_context, ale atomowo (find_one_and_update) zwraca dokument
+    po zmianie - dla narzędzi, które potrzebują pozostałych pól.
+    
+    Returns:
+        Zaktualizowany dokument lub None w przypadku błędu albo gdy dokument
+        nie istnieje, a upsert=False
+    """
+    try:
+        update = _brandhero_update(brandhero_context, previous_response_id, brandhero_description, image_url)
+        doc = await get_collection(COMPANY_BRANDHERO_COLLECTION).find_one_and_update(
             {"company_id": company_id},
-            {"$set": update_data},
-            upsert=True
+            update,
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER
         )
+        await brandhero_cache.touch(company_id)
         
         logger.info(f"Updated brand hero context for company_id={company_id} in MongoDB")
-        return True
+        return doc
     except Exception as e:
         logger.error(f"Error updating brand hero context in MongoDB: {str(e)}")
-        return False
+        return None
+
+async def store_visual_identity(
+    company_id: str,
+    visual_identity: Dict[str, Any],
+    source_hash: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Zapisuje pakiet tożsamości wizualnej w dokumencie brand hero i atomowo
+    podbija jego wersję. `source_hash` to skrót danych, z których pakiet powstał.
+    
+    Returns:
+        Zapisany pakiet (z wersją) lub None, jeśli dokument brand hero nie istnieje
+        albo wystąpił błąd
+    """
+    try:
+        fields = {f"visual_identity.{k}": v for k, v in visual_identity.items()}
+        fields["visual_identity.source_hash"] = source_hash
+        doc = await get_collection(COMPANY_BRANDHERO_COLLECTION).find_one_and_update(
+            {"company_id": company_id},
+            {
+                "$set": fields,
+                "$inc": {"visual_identity.version": 1},
+                "$currentDate": {"visual_identity.built_at": True}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        await brandhero_cache.touch(company_id)
+        return doc.get("visual_identity") if doc else None
+    except Exception as e:
+        logger.error(f"Error storing visual identity for company_id={company_id}: {str(e)}")
+        return None
@@ -0,0 +1,175 @@
+from typing import Any, Dict, Optional
+import asyncio
+import copy
+import logging
+import os
+from bson.timestamp import Timestamp
+from pymongo.errors import OperationFailure
+from app.db.lru import TTLCache
+from app.db.mongo import get_collection, get_database
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSIONS_COLLECTION = "cache_versions"
+
+DOC_CACHE_SIZE = int(os.getenv("DOC_CACHE_SIZE", "1024"))
+# TTL ogranicza nieaktualność także wtedy, gdy unieważnienie z innego procesu nie dotrze
+DOC_CACHE_TTL_SECONDS = float(os.getenv("DOC_CACHE_TTL_SECONDS", "300"))
+DOC_CACHE_POLL_SECONDS = float(os.getenv("DOC_CACHE_POLL_SECONDS", "1"))
+
+_MISSING = object()
+
+
+class DocumentCache:
+    """
+    Cache read-through (per proces) dokumentów kolekcji trzymanych po company_id.
+
+    Zapisy w tym procesie unieważniają wpis od razu (touch); zapisy z innych procesów
+    docierają przez change stream MongoDB albo - bez replica setu - przez licznik
+    wersji w kolekcji cache_versions.
+    """
+
+    def __init__(self, collection: str, maxsize: int = DOC_CACHE_SIZE, ttl: float = DOC_CACHE_TTL_SECONDS):
+        self.collection = collection
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Podbijane przy każdym unieważnieniu: odczyt, który trwał w jego trakcie, nie trafi do cache
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, company_id: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Zwraca kopię dokumentu firmy (albo None). `fresh` wymusza odczyt z bazy,
+        np. dla stanu rozmowy, który inny proces mógł właśnie zmienić.
+        """
+        doc = _MISSING if fresh else self._cache.get(company_id, _MISSING)
+        if doc is _MISSING:
+            self.misses += 1
+            generation = self._generation
+            doc = await get_collection(self.collection).find_one({"company_id": company_id})
+            if generation == self._generation:
+                self._cache.set(company_id, doc)
+        else:
+            self.hits += 1
+        return copy.deepcopy(doc)
+
+    def invalidate(self, company_id: Optional[str] = None) -> None:
+        self._generation += 1
+        if company_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(company_id)
+
+    async def touch(self, company_id: str) -> None:
+        """
+        Wywoływane po każdym zapisie dokumentu firmy: unieważnia lokalny wpis
+        i podbija wersję, którą widzą procesy bez change streamu. Przy change
+        streamie sam zapis dociera do innych procesów - bez dodatkowego zapisu.
+        """
+        self.invalidate(company_id)
+        if _mode == "change_stream":
+            return
+        try:
+            await get_collection(CACHE_VERSIONS_COLLECTION).update_one(
+                {"_id": f"{self.collection}:{company_id}"},
+                {
+                    "$set": {"collection": self.collection, "company_id": company_id},
+                    "$currentDate": {"ts": {"$type": "timestamp"}}
+                },
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error bumping cache version for {self.collection}:{company_id}: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+company_context_cache = DocumentCache("company_context_memory")
+brandhero_cache = DocumentCache("company_brandhero_memory")
+strategy_cache = DocumentCache("strategies")
+
+_caches: Dict[str, DocumentCache] = {
+    cache.collection: cache for cache in (company_context_cache, brandhero_cache, strategy_cache)
+}
+_invalidation_task: Optional[asyncio.Task] = None
+_mode = "off"
+
+
+def _invalidate_all() -> None:
+    for cache in _caches.values():
+        cache.invalidate()
+
+
+async def _watch_changes() -> None:
+    """
+    Unieważnia wpisy na podstawie change streamu bazy. Pełny dokument (updateLookup)
+    daje company_id także dla update; przy delete czyścimy całą kolekcję.
+    """
+    global _mode
+    pipeline = [{"$match": {"ns.coll": {"$in": list(_caches)}}}]
+    async with get_database().watch(pipeline, full_document="updateLookup") as stream:
+        _mode = "change_stream"
+        logger.info("Document cache invalidation via change stream")
+        async for change in stream:
+            cache = _caches.get(change["ns"]["coll"])
+            company_id = (change.get("fullDocument") or {}).get("company_id")
+            if company_id is not None:
+                cache.invalidate(company_id)
+            else:
+                cache.invalidate()
+
+
+async def _poll_versions() -> None:
+    global _mode
+    _mode = "version_poll"
+    logger.info("Document cache invalidation via version polling")
+    versions = get_collection(CACHE_VERSIONS_COLLECTION)
+    last = await versions.find_one({}, {"ts": 1}, sort=[("ts", -1)])
+    last_ts = last["ts"] if last else Timestamp(0, 0)
+    while True:
+        await asyncio.sleep(DOC_CACHE_POLL_SECONDS)
+        try:
+            async for doc in versions.find({"ts": {"$gt": last_ts}}, {"collection": 1, "company_id": 1, "ts": 1}):
+                cache = _caches.get(doc["collection"])
+                if cache is not None:
+                    cache.invalidate(doc["company_id"])
+                last_ts = max(last_ts, doc["ts"])
+        except Exception as e:
+            logger.error(f"Error polling cache versions: {str(e)}")
+
+
+async def _run_invalidation() -> None:
+    while True:
+        try:
+            await _watch_changes()
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            # Standalone MongoDB nie ma change streamów
+            logger.warning(f"Change streams unavailable ({str(e)}), falling back to version polling")
+            await _poll_versions()
+        except Exception as e:
+            logger.error(f"Document cache change stream failed: {str(e)}")
+        # Zdarzenia mogły przepaść - zaczynamy od pustego cache
+        _invalidate_all()
+        await asyncio.sleep(DOC_CACHE_POLL_SECONDS)
+
+
+def start_cache_invalidation() -> None:
+    global _invalidation_task
+    if _invalidation_task is None:
+        _invalidation_task = asyncio.create_task(_run_invalidation())
+
+
+async def stop_cache_invalidation() -> None:
+    global _invalidation_task, _mode
+    if _invalidation_task is not None:
+        _invalidation_task.cancel()
+        await asyncio.gather(_invalidation_task, return_exceptions=True)
+        _invalidation_task = None
+        _mode = "off"
+
+
+def cache_status() -> Dict[str, Any]:
+    return {"invalidation": _mode, **{name: cache.stats() for name, cache in _caches.items()}}
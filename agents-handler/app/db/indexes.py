@@ -0,0 +1,139 @@
+from typing import Any, Dict, List, Tuple
+import logging
+from app.db.mongo import get_collection
+from app.db.company_context_db import (
+    COMPANY_CONTEXT_COLLECTION,
+    COMPANY_INITIAL_COLLECTION,
+    COMPANY_BRANDHERO_COLLECTION,
+    GRIDFS_FILES_COLLECTION
+)
+from app.db.research_cache import RESEARCH_CACHE_COLLECTION
+from app.db.doc_cache import CACHE_VERSIONS_COLLECTION
+from app.db.memo import MEMO_COLLECTION
+from app.db.singleflight import LEASES_COLLECTION, SINGLEFLIGHT_RESULTS_COLLECTION
+from app.images.refs import IMAGE_REFS_COLLECTION
+from app.jobs.queue import JOBS_COLLECTION
+from app.jobs.post_pool import POST_POOL_COMPANIES_COLLECTION
+
+logger = logging.getLogger(__name__)
+
+IndexKeys = List[Tuple[str, int]]
+
+# Kolekcja -> wymagane indeksy (klucze + opcje create_index).
+# Każde zapytanie serwisu powinno trafiać w któryś z nich.
+REQUIRED_INDEXES: Dict[str, List[Dict[str, Any]]] = {
+    COMPANY_CONTEXT_COLLECTION: [
+        {"keys": [("company_id", 1)], "unique": True},
+    ],
+    # Dane wstępne zapisuje proces onboardingu - nie zakładamy, że są unikalne
+    COMPANY_INITIAL_COLLECTION: [
+        {"keys": [("company_id", 1)]},
+    ],
+    COMPANY_BRANDHERO_COLLECTION: [
+        {"keys": [("company_id", 1)], "unique": True},
+    ],
+    "strategies": [
+        {"keys": [("company_id", 1)], "unique": True},
+    ],
+    "strategy_conversations": [
+        {"keys": [("company_id", 1)], "unique": True},
+    ],
+    "posts": [
+        {"keys": [("post_id", 1)], "unique": True},
+        # Pula gotowych propozycji; zwykłe posty nie mają pool_status
+        {"keys": [("company_id", 1), ("pool_status", 1), ("pooled_at", 1)], "partialFilterExpression": {"pool_status": {"$exists": True}}},
+        {"keys": [("pool_status", 1), ("served_at", 1)], "partialFilterExpression": {"pool_status": {"$exists": True}}},
+    ],
+    "post_edit_conversations": [
+        {"keys": [("conversation_id", 1)], "unique": True},
+    ],
+    GRIDFS_FILES_COLLECTION: [
+        # Deduplikacja po treści; pliki sprzed adresowania treścią nie mają skrótu
+        {"keys": [("metadata.sha256", 1)], "unique": True, "partialFilterExpression": {"metadata.sha256": {"$exists": True}}},
+        {"keys": [("metadata.source_url", 1)], "sparse": True},
+        {"keys": [("metadata.variant_of", 1), ("metadata.variant", 1), ("metadata.format", 1)], "sparse": True},
+    ],
+    IMAGE_REFS_COLLECTION: [
+        {"keys": [("file_id", 1)]},
+    ],
+    RESEARCH_CACHE_COLLECTION: [
+        {"keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+    ],
+    MEMO_COLLECTION: [
+        {"keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+    ],
+    POST_POOL_COMPANIES_COLLECTION: [
+        {"keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+    ],
+    JOBS_COLLECTION: [
+        {"keys": [("status", 1), ("created_at", 1)]},
+        {"keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+    ],
+    LEASES_COLLECTION: [
+        {"keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+    ],
+    SINGLEFLIGHT_RESULTS_COLLECTION: [
+        {"keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+    ],
+    CACHE_VERSIONS_COLLECTION: [
+        {"keys": [("ts", 1)]},
+    ],
+}
+
+
+def _key_pattern(keys: Any) -> Tuple[Tuple[str, int], ...]:
+    items = keys.items() if hasattr(keys, "items") else keys
+    return tuple((field, int(direction)) for field, direction in items)
+
+
+async def ensure_indexes() -> Dict[str, Any]:
+    """
+    Tworzy wszystkie wymagane indeksy. Błąd jednego indeksu (np. duplikaty przy
+    indeksie unikalnym) jest logowany i nie blokuje pozostałych ani startu aplikacji.
+    Zwraca raport z report_indexes().
+    """
+    for collection, specs in REQUIRED_INDEXES.items():
+        for spec in specs:
+            options = {k: v for k, v in spec.items() if k != "keys"}
+            try:
+                await get_collection(collection).create_index(spec["keys"], **options)
+            except Exception as e:
+                logger.error(f"Could not create index {spec['keys']} on {collection}: {str(e)}")
+    report = await report_indexes()
+    for item in report["missing"]:
+        logger.warning(f"Missing index on {item['collection']}: {item['keys']}")
+    return report
+
+
+async def report_indexes() -> Dict[str, Any]:
+    """
+    Porównuje indeksy w bazie z REQUIRED_INDEXES.
+
+    Returns:
+        {"missing": [...], "unused": [...]} - brakujące wymagane indeksy oraz
+        istniejące indeksy (poza _id), których od startu serwera MongoDB nikt nie użył.
+    """
+    missing: List[Dict[str, Any]] = []
+    unused: List[Dict[str, Any]] = []
+    for collection, specs in REQUIRED_INDEXES.items():
+        coll = get_collection(collection)
+        try:
+            existing = {_key_pattern(index["key"]) async for index in coll.list_indexes()}
+        except Exception as e:
+            logger.error(f"Could not list indexes of {collection}: {str(e)}")
+            continue
+        for spec in specs:
+            if _key_pattern(spec["keys"]) not in existing:
+                missing.append({"collection": collection, "keys": spec["keys"]})
+        try:
+            async for stats in coll.aggregate([{"$indexStats": {}}]):
+                if stats["name"] != "_id_" and stats["accesses"]["ops"] == 0:
+                    unused.append({
+                        "collection": collection,
+                        "name": stats["name"],
+                        "since": stats["accesses"]["since"]
+                    })
+        except Exception as e:
+            # $indexStats wymaga uprawnień clusterMonitor - brak statystyk nie jest błędem
+            logger.debug(f"Index usage stats unavailable for {collection}: {str(e)}")
+    return {"missing": missing, "unused": unused}
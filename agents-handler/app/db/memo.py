@@ -0,0 +1,116 @@
+from typing import Any, Awaitable, Callable, Dict
+from datetime import datetime, timedelta, timezone
+import asyncio
+import logging
+import os
+from app.db.lru import TTLCache
+from app.db.mongo import get_collection
+from app.db.research_cache import context_hash
+
+logger = logging.getLogger(__name__)
+
+MEMO_COLLECTION = "memo"
+
+# Wpis nieużywany przez TTL jest usuwany (indeks TTL w MongoDB, LRU w procesie)
+MEMO_TTL_SECONDS = float(os.getenv("MEMO_TTL_SECONDS", str(30 * 24 * 3600)))
+MEMO_LRU_SIZE = int(os.getenv("MEMO_LRU_SIZE", "256"))
+
+_MISSING = object()
+
+
+class _ComputeCancelled(Exception):
+    """Wyliczenie, na które czekano, zostało anulowane - trzeba spróbować od nowa."""
+
+_lru = TTLCache(maxsize=MEMO_LRU_SIZE, ttl=MEMO_TTL_SECONDS)
+_inflight: Dict[str, "asyncio.Future[Any]"] = {}
+
+
+def memo_key(kind: str, inputs: Any) -> str:
+    """
+    Klucz adresowany treścią: rodzaj kroku + skrót wszystkich jego danych wejściowych.
+    """
+    return f"{kind}:{context_hash(inputs)}"
+
+
+async def _load(key: str) -> Any:
+    value = _lru.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+    try:
+        # Odczyt przesuwa termin wygaśnięcia - usuwane są wpisy dawno nieużywane
+        doc = await get_collection(MEMO_COLLECTION).find_one_and_update(
+            {"_id": key},
+            {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=MEMO_TTL_SECONDS)}},
+            {"value": 1}
+        )
+    except Exception as e:
+        logger.error(f"Error reading memo {key} from MongoDB: {str(e)}")
+        return _MISSING
+    if not doc:
+        return _MISSING
+    _lru.set(key, doc["value"])
+    return doc["value"]
+
+
+async def _store(key: str, kind: str, value: Any) -> None:
+    _lru.set(key, value)
+    now = datetime.now(timezone.utc)
+    try:
+        await get_collection(MEMO_COLLECTION).update_one(
+            {"_id": key},
+            {"$set": {
+                "kind": kind,
+                "value": value,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=MEMO_TTL_SECONDS)
+            }},
+            upsert=True
+        )
+    except Exception as e:
+        logger.error(f"Error writing memo {key} to MongoDB: {str(e)}")
+
+
+async def memoize(kind: str, inputs: Any, compute: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Zwraca zapamiętany wynik kroku `kind` dla identycznych `inputs` albo wylicza go
+    przez `compute` i zapamiętuje. Równoległe wywołania z tym samym kluczem w procesie
+    czekają na jedno wyliczenie. Wyjątki nie są zapamiętywane.
+
+    Args:
+        kind: Rodzaj kroku (np. "brandhero_prompt")
+        inputs: Wszystko, od czego zależy wynik (prompt, model, skrót obrazu...)
+        compute: Funkcja wyliczająca wynik (wartość musi dać się zapisać w BSON)
+
+    Returns:
+        Wynik z pamięci lub świeżo wyliczony
+    """
+    key = memo_key(kind, inputs)
+    value = await _load(key)
+    if value is not _MISSING:
+        logger.info(f"Memo hit for {kind}")
+        return value
+
+    while key in _inflight:
+        try:
+            return await asyncio.shield(_inflight[key])
+        except _ComputeCancelled:
+            # Anulowane zostało tylko wywołanie liczące - czekający liczą sami
+            pass
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        value = await compute()
+        await _store(key, kind, value)
+        future.set_result(value)
+        return value
+    except asyncio.CancelledError:
+        future.set_exception(_ComputeCancelled())
+        future.exception()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Wyjątek jest przekazywany wywołującemu; oczekujący odbiorą go z future
+        future.exception()
+        raise
+    finally:
+        _inflight.pop(key, None)
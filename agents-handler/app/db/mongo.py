@@ -0,0 +1,89 @@
+from typing import Optional
+import logging
+import os
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorCollection
+from dotenv import load_dotenv
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Konfiguracja połączenia (wspólna dla całego workera)
+MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
+MONGO_DB = os.getenv("MONGO_DB") or os.getenv("MONGODB_DB") or "brand-hero"
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "30000"))
+
+_client: Optional[AsyncIOMotorClient] = None
+
+
+def get_client() -> AsyncIOMotorClient:
+    """
+    Zwraca jedyny, współdzielony klient MongoDB dla tego procesu.
+
+    Klient jest tworzony w lifespan aplikacji (connect_mongo); jeśli moduł jest
+    używany poza aplikacją (np. w skrypcie), klient zostanie utworzony leniwie.
+    """
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(
+            MONGODB_URI,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+            appname="agents-handler",
+        )
+        logger.info(f"Created MongoDB client (db={MONGO_DB}, maxPoolSize={MONGO_MAX_POOL_SIZE})")
+    return _client
+
+
+def get_database() -> AsyncIOMotorDatabase:
+    """
+    Zwraca bazę danych aplikacji ze współdzielonego klienta.
+    """
+    return get_client()[MONGO_DB]
+
+
+def get_collection(name: str) -> AsyncIOMotorCollection:
+    """
+    Zwraca kolekcję o podanej nazwie ze współdzielonego klienta.
+
+    Args:
+        name: Nazwa kolekcji
+
+    Returns:
+        Kolekcja MongoDB
+    """
+    return get_database()[name]
+
+
+async def connect_mongo() -> None:
+    """
+    Tworzy współdzielonego klienta i sprawdza połączenie z serwerem.
+    Wywoływane przy starcie aplikacji.
+    """
+    client = get_client()
+    try:
+        await client.admin.command("ping")
+        logger.info("Connected to MongoDB")
+    except Exception as e:
+        # Nie blokujemy startu - sterownik połączy się ponownie przy pierwszym zapytaniu
+        logger.error(f"MongoDB ping failed on startup: {str(e)}")
+
+
+def close_mongo() -> None:
+    """
+    Zamyka współdzielonego klienta (pulę połączeń i wątki monitorujące).
+    Wywoływane przy zamykaniu aplikacji.
+    """
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+        logger.info("Closed MongoDB client")
@@ -0,0 +1,130 @@
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+from datetime import datetime, timedelta, timezone
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from app.db.lru import TTLCache
+from app.db.mongo import get_collection
+
+logger = logging.getLogger(__name__)
+
+RESEARCH_CACHE_COLLECTION = "research_cache"
+
+# Wynik jest świeży przez TTL; przez kolejne STALE sekund serwujemy go dalej, odświeżając w tle
+RESEARCH_CACHE_TTL_SECONDS = float(os.getenv("RESEARCH_CACHE_TTL_SECONDS", str(6 * 3600)))
+RESEARCH_CACHE_STALE_SECONDS = float(os.getenv("RESEARCH_CACHE_STALE_SECONDS", str(24 * 3600)))
+RESEARCH_CACHE_LRU_SIZE = int(os.getenv("RESEARCH_CACHE_LRU_SIZE", "512"))
+
+_lru = TTLCache(maxsize=RESEARCH_CACHE_LRU_SIZE)
+_inflight: Dict[str, "asyncio.Future[Any]"] = {}
+_refreshing: Set[str] = set()
+_background_tasks: Set["asyncio.Task[Any]"] = set()
+
+
+def context_hash(company_context: Any) -> str:
+    """
+    Zwraca stabilny skrót (sha256) kontekstu firmy używany jako część klucza cache.
+    """
+    raw = json.dumps(company_context, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def _load(key: str) -> Optional[Dict[str, Any]]:
+    entry = _lru.get(key)
+    if entry is not None:
+        return entry
+    try:
+        doc = await get_collection(RESEARCH_CACHE_COLLECTION).find_one({"_id": key})
+    except Exception as e:
+        logger.error(f"Error reading research cache from MongoDB: {str(e)}")
+        return None
+    if not doc:
+        return None
+    entry = {"value": doc["value"], "fetched_ts": doc["fetched_ts"]}
+    _remember(key, entry)
+    return entry
+
+
+def _remember(key: str, entry: Dict[str, Any]) -> None:
+    remaining = entry["fetched_ts"] + RESEARCH_CACHE_TTL_SECONDS + RESEARCH_CACHE_STALE_SECONDS - time.time()
+    if remaining > 0:
+        _lru.set(key, entry, ttl=remaining)
+
+
+async def _store(key: str, kind: str, value: Any) -> None:
+    now = time.time()
+    entry = {"value": value, "fetched_ts": now}
+    _remember(key, entry)
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=RESEARCH_CACHE_TTL_SECONDS + RESEARCH_CACHE_STALE_SECONDS)
+    try:
+        await get_collection(RESEARCH_CACHE_COLLECTION).update_one(
+            {"_id": key},
+            {"$set": {"kind": kind, "value": value, "fetched_ts": now, "expires_at": expires_at}},
+            upsert=True
+        )
+    except Exception as e:
+        logger.error(f"Error writing research cache to MongoDB: {str(e)}")
+
+
+async def _fetch_and_store(key: str, kind: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    # Jedno zapytanie na klucz w obrębie procesu - pozostali czekają na ten sam wynik
+    future = _inflight.get(key)
+    if future is not None:
+        return await asyncio.shield(future)
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        value = await fetch()
+        await _store(key, kind, value)
+        future.set_result(value)
+        return value
+    except BaseException as e:
+        future.set_exception(e)
+        # Wyjątek jest przekazywany wywołującemu; oczekujący odbiorą go z future
+        future.exception()
+        raise
+    finally:
+        _inflight.pop(key, None)
+
+
+async def _refresh(key: str, kind: str, fetch: Callable[[], Awaitable[Any]]) -> None:
+    try:
+        await _fetch_and_store(key, kind, fetch)
+        logger.info(f"Refreshed research cache entry {key}")
+    except Exception as e:
+        # Zostawiamy nieaktualną wartość - lepsza niż żadna, gdy Perplexity nie odpowiada
+        logger.warning(f"Background refresh of research cache entry {key} failed: {str(e)}")
+    finally:
+        _refreshing.discard(key)
+
+
+async def get_or_fetch(kind: str, company_context: Any, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Zwraca wynik researchu z cache (LRU w procesie, potem MongoDB) lub wywołuje fetch.
+
+    Świeży wpis jest zwracany od razu. Nieaktualny (po TTL, ale w oknie "stale") również
+    jest zwracany od razu, a odświeżenie uruchamiane jest w tle (stale-while-revalidate).
+    Wyjątki z fetch nie są cache'owane i są przekazywane wywołującemu.
+
+    Args:
+        kind: Rodzaj zapytania (np. "trends", "news")
+        company_context: Kontekst firmy, z którego liczony jest skrót klucza
+        fetch: Funkcja pobierająca świeży wynik
+
+    Returns:
+        Wynik z cache lub świeżo pobrany
+    """
+    key = f"{kind}:{context_hash(company_context)}"
+    entry = await _load(key)
+    if entry is not None:
+        age = time.time() - entry["fetched_ts"]
+        if age > RESEARCH_CACHE_TTL_SECONDS and key not in _refreshing:
+            _refreshing.add(key)
+            task = asyncio.create_task(_refresh(key, kind, fetch))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        return entry["value"]
+    return await _fetch_and_store(key, kind, fetch)
@@ -0,0 +1,209 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+import asyncio
+import logging
+import os
+import socket
+import uuid
+import weakref
+from pymongo.errors import DuplicateKeyError
+from app.db.mongo import get_collection
+from app.db.research_cache import context_hash
+
+logger = logging.getLogger(__name__)
+
+LEASES_COLLECTION = "leases"
+SINGLEFLIGHT_RESULTS_COLLECTION = "singleflight_results"
+
+# Lease wygasa, jeśli proces go trzymający przestanie go odnawiać (np. padnie)
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", "60"))
+LEASE_WAIT_SECONDS = float(os.getenv("LEASE_WAIT_SECONDS", "300"))
+LEASE_POLL_SECONDS = float(os.getenv("LEASE_POLL_SECONDS", "0.5"))
+# Jak długo wynik zakończonego przebiegu może obsłużyć czekające na niego żądania z innych procesów
+SINGLEFLIGHT_RESULT_TTL_SECONDS = float(os.getenv("SINGLEFLIGHT_RESULT_TTL_SECONDS", "60"))
+
+# Losowy sufiks: repliki w kontenerach mają zwykle ten sam pid (1), a czasem i nazwę hosta
+_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_inflight: Dict[str, "asyncio.Future[Any]"] = {}
+_local_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+class LeaseTimeout(Exception):
+    pass
+
+
+class _LeaderCancelled(Exception):
+    """Przebieg, do którego dołączyło żądanie, został anulowany - trzeba spróbować od nowa."""
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+async def _try_acquire(name: str) -> bool:
+    now = _now()
+    try:
+        await get_collection(LEASES_COLLECTION).update_one(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": _OWNER}]},
+            {"$set": {"owner": _OWNER, "acquired_at": now, "expires_at": now + timedelta(seconds=LEASE_TTL_SECONDS)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Dokument istnieje i należy do innego procesu
+        return False
+
+
+async def _renew(name: str) -> None:
+    while True:
+        await asyncio.sleep(LEASE_TTL_SECONDS / 3)
+        try:
+            await get_collection(LEASES_COLLECTION).update_one(
+                {"_id": name, "owner": _OWNER},
+                {"$set": {"expires_at": _now() + timedelta(seconds=LEASE_TTL_SECONDS)}}
+            )
+        except Exception as e:
+            logger.error(f"Error renewing lease {name}: {str(e)}")
+
+
+@asynccontextmanager
+async def lease(name: str, wait_seconds: float = LEASE_WAIT_SECONDS) -> AsyncIterator[None]:
+    """
+    Wyłączny dostęp do zasobu `name` w obrębie wszystkich procesów.
+    W procesie kolejkuje się na asyncio.Lock, między procesami na dokumencie w MongoDB.
+    Rzuca LeaseTimeout, jeśli nie uda się go uzyskać w `wait_seconds`.
+    """
+    local = _local_locks.get(name)
+    if local is None:
+        local = _local_locks[name] = asyncio.Lock()
+    try:
+        await asyncio.wait_for(local.acquire(), wait_seconds)
+    except asyncio.TimeoutError:
+        raise LeaseTimeout(f"Timed out waiting for {name}")
+    try:
+        deadline = asyncio.get_running_loop().time() + wait_seconds
+        while not await _try_acquire(name):
+            if asyncio.get_running_loop().time() >= deadline:
+                raise LeaseTimeout(f"Timed out waiting for {name}")
+            await asyncio.sleep(LEASE_POLL_SECONDS)
+        renewer = asyncio.create_task(_renew(name))
+        try:
+            yield
+        finally:
+            renewer.cancel()
+            await asyncio.gather(renewer, return_exceptions=True)
+            try:
+                await get_collection(LEASES_COLLECTION).delete_one({"_id": name, "owner": _OWNER})
+            except Exception as e:
+                logger.error(f"Error releasing lease {name}: {str(e)}")
+    finally:
+        local.release()
+
+
+def company_lock(company_id: str):
+    """
+    Serializuje zmiany stanu rozmowy (previous_response_id itp.) jednej firmy.
+    """
+    return lease(f"company:{company_id}")
+
+
+async def locked_stream(company_id: str, events: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    """
+    Przepuszcza strumień zdarzeń, trzymając blokadę firmy aż do jego końca.
+    """
+    async with company_lock(company_id):
+        async for event in events:
+            yield event
+
+
+async def _shared_result(key: str, since: datetime) -> Optional[Dict[str, Any]]:
+    try:
+        return await get_collection(SINGLEFLIGHT_RESULTS_COLLECTION).find_one(
+            {"_id": key, "finished_at": {"$gte": since}}
+        )
+    except Exception as e:
+        logger.error(f"Error reading single-flight result: {str(e)}")
+        return None
+
+
+async def _share_result(key: str, result: Any) -> None:
+    now = _now()
+    try:
+        await get_collection(SINGLEFLIGHT_RESULTS_COLLECTION).update_one(
+            {"_id": key},
+            {"$set": {
+                "result": result,
+                "finished_at": now,
+                "expires_at": now + timedelta(seconds=SINGLEFLIGHT_RESULT_TTL_SECONDS)
+            }},
+            upsert=True
+        )
+    except Exception as e:
+        # Np. wynik nie daje się zapisać jako BSON - inne procesy po prostu policzą go same
+        logger.error(f"Error storing single-flight result: {str(e)}")
+
+
+async def run_once(
+    endpoint: str,
+    company_id: str,
+    payload: Any,
+    fn: Callable[[], Awaitable[Any]],
+    exclusive: bool = True
+) -> Any:
+    """
+    Wykonuje `fn` raz dla identycznych, równoległych żądań (ten sam endpoint, firma
+    i skrót danych wejściowych) i oddaje wszystkim ten sam wynik.
+
+    W procesie czekający dzielą jedną przyszłość; między procesami przebieg chroni
+    lease w MongoDB, a wynik jest odkładany na chwilę, żeby proces czekający na lease
+    nie uruchamiał agenta drugi raz. Przy `exclusive` lease obejmuje całą firmę,
+    więc różne przebiegi zmieniające stan rozmowy idą po kolei.
+    """
+    key = f"{endpoint}:{company_id}:{context_hash(payload)}"
+    while True:
+        inflight = _inflight.get(key)
+        if inflight is None:
+            return await _lead(key, endpoint, company_id, fn, exclusive)
+        logger.info(f"Joining in-flight run {endpoint} for company_id={company_id}")
+        try:
+            return await asyncio.shield(inflight)
+        except _LeaderCancelled:
+            # Anulowanie prowadzącego nie dotyczy pozostałych - jeden z nich przejmuje przebieg
+            logger.info(f"In-flight run {endpoint} for company_id={company_id} was cancelled, retrying")
+
+
+async def _lead(
+    key: str,
+    endpoint: str,
+    company_id: str,
+    fn: Callable[[], Awaitable[Any]],
+    exclusive: bool
+) -> Any:
+    future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        started = _now()
+        async with lease(f"company:{company_id}" if exclusive else key):
+            shared = await _shared_result(key, started)
+            if shared is not None:
+                logger.info(f"Reusing result of {endpoint} for company_id={company_id} from another worker")
+                result = shared["result"]
+            else:
+                result = await fn()
+                await _share_result(key, result)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        # Nie anulujemy przyszłości - czekający mogą być nadal połączeni i ponowią przebieg
+        future.set_exception(_LeaderCancelled())
+        future.exception()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Nikt nie czeka - nie zgłaszaj "Future exception was never retrieved"
+        future.exception()
+        raise
+    finally:
+        _inflight.pop(key, None)
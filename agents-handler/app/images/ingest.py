@@ -0,0 +1,41 @@
+import asyncio
+import logging
+from typing import Any, Optional, Set, Tuple
+from app.db.company_context_db import store_image_in_gridfs
+from app.images.variants import create_variants
+
+logger = logging.getLogger(__name__)
+
+_background_tasks: Set["asyncio.Task[Any]"] = set()
+
+
+async def _create_variants_safely(file_id: str) -> None:
+    try:
+        await create_variants(file_id)
+    except Exception as e:
+        logger.error("Creating variants for image %s failed: %s", file_id, e)
+
+
+async def ingest_image(
+    image_url: str,
+    company_id: str,
+    description: Optional[str] = None,
+    source: str = "brand_hero_generator",
+    filename: Optional[str] = None
+) -> Tuple[bool, Optional[str]]:
+    """
+    Store an image from `image_url` in GridFS and render its variants in the background.
+    Returns (success, file_id).
+    """
+    success, file_id, _ = await store_image_in_gridfs(
+        image_url=image_url,
+        company_id=company_id,
+        description=description,
+        source=source,
+        filename=filename
+    )
+    if success and file_id:
+        task = asyncio.create_task(_create_variants_safely(file_id))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    return success, file_id
@@ -0,0 +1,130 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from app.images.ingest import ingest_image
+from app.images.refs import set_image_ref
+from app.db.lru import TTLCache
+from app.db.mongo import get_collection
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PERSIST_WORKERS = int(os.getenv("IMAGE_PERSIST_WORKERS", "2"))
+IMAGE_PERSIST_QUEUE_SIZE = int(os.getenv("IMAGE_PERSIST_QUEUE_SIZE", "100"))
+
+# (image_url, company_id, post_id, description) -> stable URL, or None on failure
+BlobStore = Callable[[str, str, str, Optional[str]], Awaitable[Optional[str]]]
+
+
+async def gridfs_store(image_url: str, company_id: str, post_id: str, description: Optional[str]) -> Optional[str]:
+    """Default blob store: copy the image into GridFS and serve it via /api/images/{id}."""
+    success, file_id = await ingest_image(
+        image_url=image_url,
+        company_id=company_id,
+        description=description,
+        source="post_generator",
+        filename=f"post_{post_id}.png"
+    )
+    return f"/api/images/{file_id}" if success and file_id else None
+
+
+def is_temporary_url(image_url: Optional[str]) -> bool:
+    """OpenAI image links are absolute URLs; our own stable links are relative."""
+    return bool(image_url) and image_url.startswith(("http://", "https://"))
+
+
+class ImagePersistenceQueue:
+    """
+    Bounded background worker pool that copies generated post images out of the
+    short-lived OpenAI URLs into a blob store and rewrites the saved post.
+    """
+
+    def __init__(
+        self,
+        workers: int = IMAGE_PERSIST_WORKERS,
+        maxsize: int = IMAGE_PERSIST_QUEUE_SIZE,
+        store: BlobStore = gridfs_store
+    ):
+        self.workers = max(1, workers)
+        self.store = store
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=maxsize)
+        self._tasks: List[asyncio.Task] = []
+        # temporary URL -> stable URL, so posts saved later pick up the stable link
+        self._persisted = TTLCache(maxsize=2048, ttl=2 * 3600)
+        self.stats = {"queued": 0, "in_progress": 0, "completed": 0, "failed": 0, "dropped": 0}
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info("Started %s image persistence workers", self.workers)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, post_id: str, company_id: str, image_url: str, description: Optional[str] = None) -> bool:
+        """
+        Schedule an image for persistence without waiting for it.
+        Returns False when the URL is not temporary or the queue is full.
+        """
+        if not is_temporary_url(image_url):
+            return False
+        try:
+            self.queue.put_nowait({
+                "post_id": post_id,
+                "company_id": company_id,
+                "image_url": image_url,
+                "description": description
+            })
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.warning("Image persistence queue full, dropping image for post_id=%s", post_id)
+            return False
+        self.stats["queued"] += 1
+        return True
+
+    def persisted_url(self, image_url: Optional[str]) -> Optional[str]:
+        """Stable URL for an already persisted temporary URL, if known."""
+        return self._persisted.get(image_url) if image_url else None
+
+    def progress(self) -> Dict[str, Any]:
+        return {**self.stats, "pending": self.queue.qsize(), "workers": len(self._tasks)}
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job = await self.queue.get()
+            self.stats["queued"] -= 1
+            self.stats["in_progress"] += 1
+            try:
+                await self._persist(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error("Persisting image for post_id=%s failed: %s", job["post_id"], e)
+            finally:
+                self.stats["in_progress"] -= 1
+                self.queue.task_done()
+
+    async def _persist(self, job: Dict[str, Any]) -> None:
+        stable_url = await self.store(job["image_url"], job["company_id"], job["post_id"], job["description"])
+        if not stable_url:
+            self.stats["failed"] += 1
+            return
+        self._persisted.set(job["image_url"], stable_url)
+        # Only rewrite posts that still point at the temporary link
+        result = await get_collection("posts").update_one(
+            {"post_id": job["post_id"], "image_url": job["image_url"]},
+            {"$set": {"image_url": stable_url}}
+        )
+        if result.matched_count:
+            await set_image_ref(f"post:{job['post_id']}", stable_url)
+        self.stats["completed"] += 1
+        logger.info("Persisted image for post_id=%s as %s", job["post_id"], stable_url)
+
+
+# Shared per-worker instance, started in the app lifespan
+image_persistence = ImagePersistenceQueue()
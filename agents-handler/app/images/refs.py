@@ -0,0 +1,97 @@
+import os
+import re
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from app.db.mongo import get_collection, get_database
+
+logger = logging.getLogger(__name__)
+
+IMAGE_REFS_COLLECTION = "image_refs"
+# Unreferenced files younger than this are kept (e.g. post images not saved yet)
+IMAGE_GC_GRACE_SECONDS = float(os.getenv("IMAGE_GC_GRACE_SECONDS", str(24 * 3600)))
+IMAGE_GC_INTERVAL_SECONDS = float(os.getenv("IMAGE_GC_INTERVAL_SECONDS", str(6 * 3600)))
+
+_IMAGE_URL_RE = re.compile(r"^/api/images/([0-9a-fA-F]{24})(?:[/?].*)?$")
+
+_gc_task: Optional[asyncio.Task] = None
+
+
+def image_file_id(image_url: Optional[str]) -> Optional[ObjectId]:
+    """GridFS id behind one of our /api/images/{id} URLs, or None for any other URL."""
+    match = _IMAGE_URL_RE.match(image_url or "")
+    return ObjectId(match.group(1)) if match else None
+
+
+async def set_image_ref(ref: str, image_url: Optional[str]) -> None:
+    """
+    Point the reference `ref` (e.g. "brandhero:{company_id}", "post:{post_id}") at the
+    image behind `image_url`. Each ref holds one image, so replacing an image releases
+    the previous file; a URL that is not ours clears the ref.
+    """
+    file_id = image_file_id(image_url)
+    refs = get_collection(IMAGE_REFS_COLLECTION)
+    if file_id is None:
+        await refs.delete_one({"_id": ref})
+        return
+    await refs.update_one(
+        {"_id": ref},
+        {"$set": {"file_id": file_id, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+
+async def remove_image_ref(ref: str) -> None:
+    await get_collection(IMAGE_REFS_COLLECTION).delete_one({"_id": ref})
+
+
+async def collect_garbage(grace_seconds: float = IMAGE_GC_GRACE_SECONDS) -> int:
+    """
+    Delete content-addressed originals (and their variants) that no ref points at
+    and that are older than the grace period. Files stored before content addressing
+    (no metadata.sha256) are never touched. Returns the number of originals removed.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace_seconds)
+    fs = AsyncIOMotorGridFSBucket(get_database())
+    files = get_collection("fs.files")
+    cursor = files.aggregate([
+        {"$match": {"metadata.sha256": {"$exists": True}, "uploadDate": {"$lt": cutoff}}},
+        {"$lookup": {"from": IMAGE_REFS_COLLECTION, "localField": "_id", "foreignField": "file_id", "as": "refs"}},
+        {"$match": {"refs": {"$size": 0}}},
+        {"$project": {"_id": 1}},
+    ])
+    removed = 0
+    async for doc in cursor:
+        async for variant in files.find({"metadata.variant_of": doc["_id"]}, {"_id": 1}):
+            await fs.delete(variant["_id"])
+        await fs.delete(doc["_id"])
+        removed += 1
+    if removed:
+        logger.info("Image GC removed %s unreferenced files", removed)
+    return removed
+
+
+async def _gc_loop() -> None:
+    while True:
+        await asyncio.sleep(IMAGE_GC_INTERVAL_SECONDS)
+        try:
+            await collect_garbage()
+        except Exception as e:
+            logger.error("Image GC run failed: %s", e)
+
+
+def start_image_gc() -> None:
+    global _gc_task
+    if _gc_task is None:
+        _gc_task = asyncio.create_task(_gc_loop())
+
+
+async def stop_image_gc() -> None:
+    global _gc_task
+    if _gc_task is not None:
+        _gc_task.cancel()
+        await asyncio.gather(_gc_task, return_exceptions=True)
+        _gc_task = None
@@ -0,0 +1,126 @@
+import re
+import logging
+from email.utils import format_datetime
+from datetime import timezone
+from typing import AsyncIterator, Dict, Optional, Tuple
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorGridOut
+
+logger = logging.getLogger(__name__)
+
+# GridFS files are never modified in place, so clients and proxies may keep them forever
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def image_etag(grid_out: AsyncIOMotorGridOut) -> str:
+    """Strong ETag: the stored md5 when GridFS has one, otherwise the file ObjectId."""
+    md5 = getattr(grid_out, "md5", None)
+    return f'"{md5 or grid_out._id}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison is allowed for If-None-Match
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in candidates
+
+
+def parse_range(range_header: Optional[str], length: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single "bytes=start-end" range into an inclusive (start, end) pair.
+    Returns None when no usable range is given (multi-range requests get the full body).
+    Raises RangeNotSatisfiable when the range lies outside the file.
+    """
+    if not range_header:
+        return None
+    match = _RANGE_RE.match(range_header.strip())
+    if not match:
+        return None
+    start_s, end_s = match.groups()
+    if not start_s and not end_s:
+        return None
+    if not start_s:
+        # Suffix range: last N bytes
+        suffix = int(end_s)
+        if suffix == 0:
+            raise RangeNotSatisfiable()
+        return max(length - suffix, 0), length - 1
+    start = int(start_s)
+    end = min(int(end_s), length - 1) if end_s else length - 1
+    if start >= length or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+async def iter_gridfs(grid_out: AsyncIOMotorGridOut, start: int, end: int) -> AsyncIterator[bytes]:
+    """Yield bytes [start, end] one GridFS chunk at a time."""
+    grid_out.seek(start)
+    remaining = end - start + 1
+    chunk_size = grid_out.chunk_size
+    while remaining > 0:
+        data = await grid_out.read(min(chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def build_image_response(
+    grid_out: AsyncIOMotorGridOut,
+    request: Request,
+    content_type: str,
+    extra_headers: Optional[Dict[str, str]] = None
+) -> Response:
+    """
+    Build a streaming response for a GridFS file honouring If-None-Match and Range.
+    Memory use is bounded by the GridFS chunk size, not the file size.
+    """
+    etag = image_etag(grid_out)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMAGE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+        **(extra_headers or {}),
+    }
+    if grid_out.upload_date:
+        headers["Last-Modified"] = format_datetime(grid_out.upload_date.replace(tzinfo=timezone.utc), usegmt=True)
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    length = grid_out.length
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range and if_range.strip() != etag:
+        # The client's partial copy is outdated - send the whole file
+        range_header = None
+
+    try:
+        byte_range = parse_range(range_header, length)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{length}"})
+
+    if byte_range is None:
+        start, end, status_code = 0, length - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    headers["Content-Length"] = str(max(end - start + 1, 0))
+
+    return StreamingResponse(
+        iter_gridfs(grid_out, start, end),
+        status_code=status_code,
+        media_type=content_type,
+        headers=headers
+    )
@@ -0,0 +1,181 @@
+import io
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from app.db.company_context_db import open_image_from_gridfs
+from app.db.mongo import get_collection, get_database
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow is optional: without it only originals are served
+    Image = None
+    features = None
+
+logger = logging.getLogger(__name__)
+
+IMAGE_VARIANT_PROCESSES = int(os.getenv("IMAGE_VARIANT_PROCESSES", "2"))
+
+# Variant name -> longest edge in px (None keeps the original size, only re-encodes)
+VARIANT_SIZES: Dict[str, Optional[int]] = {
+    "thumb": 256,
+    "medium": 512,
+    "full": None,
+}
+
+# Output format -> (PIL format, content type, save options), in order of preference
+VARIANT_FORMATS: Dict[str, Tuple[str, str, Dict[str, Any]]] = {
+    "avif": ("AVIF", "image/avif", {"quality": 60}),
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": True}),
+}
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def supported_formats() -> List[str]:
+    if Image is None:
+        return []
+    formats = ["webp", "jpeg"]
+    try:
+        if features.check("avif"):
+            formats.insert(0, "avif")
+    except Exception:
+        pass
+    return formats
+
+
+def _render_variants(data: bytes, formats: List[str]) -> List[Dict[str, Any]]:
+    # Runs in a worker process: decode once, resize and encode every variant
+    source = Image.open(io.BytesIO(data))
+    source.load()
+    rendered = []
+    for variant, max_edge in VARIANT_SIZES.items():
+        image = source.copy()
+        if max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        for fmt in formats:
+            if max_edge is None and fmt == "jpeg":
+                continue  # a full-size jpeg adds nothing over the original
+            pil_format, content_type, options = VARIANT_FORMATS[fmt]
+            out = image.convert("RGB") if pil_format == "JPEG" else image
+            buf = io.BytesIO()
+            out.save(buf, format=pil_format, **options)
+            rendered.append({
+                "variant": variant,
+                "format": fmt,
+                "content_type": content_type,
+                "width": out.width,
+                "height": out.height,
+                "data": buf.getvalue(),
+            })
+    return rendered
+
+
+def start_variant_pool() -> None:
+    """
+    Create the render pool (called in the app lifespan). Workers are spawned, not
+    forked: forking a process that already runs motor / executor threads can
+    deadlock the child.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=IMAGE_VARIANT_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    # Outside the app (scripts) the pool is created on first use
+    start_variant_pool()
+    return _pool
+
+
+def shutdown_variant_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def create_variants(file_id: str) -> List[str]:
+    """
+    Render resized / re-encoded variants of a GridFS image in the process pool and
+    store them next to the original, linked through metadata.variant_of.
+    Returns the ids of the stored variants (empty when Pillow is not installed).
+    """
+    formats = supported_formats()
+    if not formats:
+        return []
+    grid_out, _ = await open_image_from_gridfs(file_id)
+    if grid_out is None:
+        return []
+    # Deduplicated uploads resolve to an existing original that already has its variants
+    if await get_collection("fs.files").find_one({"metadata.variant_of": grid_out._id}, {"_id": 1}):
+        return []
+    data = await grid_out.read()
+    metadata = grid_out.metadata or {}
+
+    loop = asyncio.get_running_loop()
+    rendered = await loop.run_in_executor(_get_pool(), _render_variants, data, formats)
+
+    fs = AsyncIOMotorGridFSBucket(get_database())
+    variant_ids = []
+    for item in rendered:
+        variant_id = await fs.upload_from_stream(
+            f"{grid_out.filename}.{item['variant']}.{item['format']}",
+            item["data"],
+            metadata={
+                "company_id": metadata.get("company_id"),
+                "content_type": item["content_type"],
+                "variant_of": grid_out._id,
+                "variant": item["variant"],
+                "format": item["format"],
+                "width": item["width"],
+                "height": item["height"],
+            }
+        )
+        variant_ids.append(str(variant_id))
+    logger.info("Stored %s variants for image %s", len(variant_ids), file_id)
+    return variant_ids
+
+
+def negotiate_format(accept: Optional[str], requested: Optional[str] = None) -> List[str]:
+    """Formats acceptable to the client, best first; an explicit ?format= wins."""
+    if requested:
+        return [requested]
+    accept = (accept or "").lower()
+    preferred = [fmt for fmt in ("avif", "webp") if f"image/{fmt}" in accept]
+    return preferred + ["jpeg"]
+
+
+async def find_variant(file_id: str, variant: Optional[str], accept: Optional[str], fmt: Optional[str] = None) -> Optional[str]:
+    """
+    Pick the stored variant of `file_id` that best matches the request.
+    Without ?variant= only a same-size re-encode the client explicitly accepts is used.
+    Returns the variant's file id, or None to serve the original.
+    """
+    if variant is None and fmt is None and not any(f in (accept or "") for f in ("image/avif", "image/webp")):
+        return None
+    try:
+        original_id = ObjectId(file_id)
+    except Exception:
+        return None
+    candidates = negotiate_format(accept, fmt)
+    if variant is None:
+        # Same size, better codec; never fall back to a lossy jpeg re-encode of the original
+        candidates = [c for c in candidates if c != "jpeg" or fmt == "jpeg"]
+    cursor = get_collection("fs.files").find(
+        {"metadata.variant_of": original_id, "metadata.variant": variant or "full", "metadata.format": {"$in": candidates}},
+        {"metadata.format": 1}
+    )
+    found = {doc["metadata"]["format"]: str(doc["_id"]) async for doc in cursor}
+    for candidate in candidates:
+        if candidate in found:
+            return found[candidate]
+    return None
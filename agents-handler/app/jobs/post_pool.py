@@ -0,0 +1,333 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from pymongo import ReturnDocument
+from app.db.mongo import get_collection
+from app.db.doc_cache import company_context_cache, brandhero_cache, strategy_cache
+from app.db.research_cache import context_hash
+from app.db.singleflight import lease, LeaseTimeout
+from app.images.persistence import image_persistence
+from app.images.refs import remove_image_ref
+
+logger = logging.getLogger(__name__)
+
+POSTS_COLLECTION = "posts"
+POST_POOL_COMPANIES_COLLECTION = "post_pool_companies"
+
+# Unserved proposals kept ready per company, and how many one GET takes
+POST_POOL_SIZE = int(os.getenv("POST_POOL_SIZE", "6"))
+POST_POOL_SERVE_COUNT = int(os.getenv("POST_POOL_SERVE_COUNT", "3"))
+POST_POOL_INTERVAL_SECONDS = float(os.getenv("POST_POOL_INTERVAL_SECONDS", "300"))
+POST_POOL_CONCURRENCY = int(os.getenv("POST_POOL_CONCURRENCY", "2"))
+POST_POOL_MAX_AGE_SECONDS = float(os.getenv("POST_POOL_MAX_AGE_SECONDS", str(24 * 3600)))
+# A company whose proposals nobody took in this long drops out of pre-generation
+POST_POOL_ACTIVE_SECONDS = float(os.getenv("POST_POOL_ACTIVE_SECONDS", str(7 * 24 * 3600)))
+# Served proposals stay around (keeping their images alive) until the user had time to save them
+POST_POOL_SERVED_RETENTION_SECONDS = float(os.getenv("POST_POOL_SERVED_RETENTION_SECONDS", str(24 * 3600)))
+# OpenAI image links expire after about an hour; older proposals need a persisted image
+TEMPORARY_IMAGE_SECONDS = 50 * 60
+# Generation runs per refill, in case runs keep coming back short
+MAX_RUNS_PER_REFILL = 3
+# After a refill that adds nothing servable, the company waits this long (doubling, capped)
+POST_POOL_RETRY_SECONDS = float(os.getenv("POST_POOL_RETRY_SECONDS", "1800"))
+POST_POOL_MAX_RETRY_SECONDS = float(os.getenv("POST_POOL_MAX_RETRY_SECONDS", str(24 * 3600)))
+
+GENERATING = "generating"
+READY = "ready"
+SERVED = "served"
+# Posts of a refill that never finished (crash, cancel) are dropped after this long
+POST_POOL_GENERATING_TIMEOUT_SECONDS = float(os.getenv("POST_POOL_GENERATING_TIMEOUT_SECONDS", "3600"))
+# Bookkeeping fields of pooled posts, dropped when a post is saved for real
+POOL_FIELDS = ("pool_status", "pool_source", "pooled_at", "served_at")
+
+# (company_id, fields to store with each post) -> generated posts (each with post_id),
+# already saved in the posts collection together with those fields
+PostGenerator = Callable[[str, Dict[str, Any]], Awaitable[List[Dict[str, Any]]]]
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+async def pool_source(company_id: str) -> str:
+    """
+    Hash of everything the proposals are generated from. Pooled posts with another
+    hash were made for an older strategy, context or brand hero and are not served.
+    """
+    context = await company_context_cache.get(company_id) or {}
+    strategy = await strategy_cache.get(company_id) or {}
+    brandhero = await brandhero_cache.get(company_id) or {}
+    return context_hash({
+        "context": {k: context.get(k) for k in ("context_description", "company_context", "strategy", "brand_hero")},
+        "strategy": strategy.get("strategy"),
+        "visual_identity": (brandhero.get("visual_identity") or {}).get("version"),
+        "brandhero_image": brandhero.get("image_url"),
+    })
+
+
+def _pooled(company_id: str, source: str) -> Dict[str, Any]:
+    # Proposals that still count toward the pool size. One whose temporary image was
+    # never persisted stays here until it ages out, so broken persistence does not
+    # turn into a paid regenerate-every-sweep loop
+    return {
+        "company_id": company_id,
+        "pool_status": READY,
+        "pool_source": source,
+        "pooled_at": {"$gte": _now() - timedelta(seconds=POST_POOL_MAX_AGE_SECONDS)},
+    }
+
+
+def _servable(company_id: str, source: str) -> Dict[str, Any]:
+    return {
+        **_pooled(company_id, source),
+        "$or": [
+            {"image_url": {"$regex": "^/api/images/"}},
+            {"image_url": {"$in": ["", None]}},
+            {"pooled_at": {"$gte": _now() - timedelta(seconds=TEMPORARY_IMAGE_SECONDS)}},
+        ],
+    }
+
+
+class PostPool:
+    """
+    Keeps a few fresh, unserved post proposals per enrolled company in the posts
+    collection, so GET /posts can answer from the pool instead of running the
+    LLM + DALL·E pipeline while the user waits. A company is enrolled explicitly
+    (enroll) or by taking proposals from its pool, and drops out after
+    POST_POOL_ACTIVE_SECONDS without a hit. Refills run in the background after
+    proposals are taken, after a strategy or context change, and on a timer.
+    """
+
+    def __init__(self, size: int = POST_POOL_SIZE, concurrency: int = POST_POOL_CONCURRENCY):
+        self.size = size
+        self.concurrency = max(1, concurrency)
+        self.generate: Optional[PostGenerator] = None
+        self.stats = {"served": 0, "misses": 0, "generated": 0, "discarded": 0}
+        self._task: Optional[asyncio.Task] = None
+        self._refills: Set[asyncio.Task] = set()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._pending: Set[str] = set()
+        self._refilling: Set[str] = set()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    async def start(self, generate: PostGenerator) -> None:
+        if self._task is not None:
+            return
+        self.generate = generate
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._task = asyncio.create_task(self._run())
+        logger.info("Started post pool (size %s per company)", self.size)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            # On Python 3.11 wait_for can swallow a cancel that races the wakeup,
+            # so the loop also checks this flag
+            self._stopping = True
+            tasks = [self._task, *self._refills]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._task = None
+
+    def request_refill(self, company_id: str) -> None:
+        """
+        Top up the company's pool soon; a no-op while the pool is not running.
+        Refills only generate for enrolled companies that are not backing off.
+        """
+        if self._task is None:
+            return
+        self._pending.add(company_id)
+        self._wakeup.set()
+
+    async def enroll(self, company_id: str) -> None:
+        """Opt the company into pre-generation and fill its pool soon."""
+        await self._mark_active(company_id)
+        self.request_refill(company_id)
+
+    async def take(self, company_id: str, count: int = POST_POOL_SERVE_COUNT) -> List[Dict[str, Any]]:
+        """
+        Claim up to `count` ready proposals, oldest first. Each claim is atomic, so
+        concurrent requests never get the same post. Empty list when the pool is dry;
+        the caller then generates live, so a miss neither refills nor enrolls.
+        """
+        source = await pool_source(company_id)
+        posts = []
+        for _ in range(count):
+            doc = await get_collection(POSTS_COLLECTION).find_one_and_update(
+                _servable(company_id, source),
+                {"$set": {"pool_status": SERVED, "served_at": _now()}},
+                sort=[("pooled_at", 1)],
+                return_document=ReturnDocument.AFTER
+            )
+            if doc is None:
+                break
+            doc.pop("_id", None)
+            # The image may have been copied to GridFS after the post was pooled
+            doc["image_url"] = image_persistence.persisted_url(doc.get("image_url")) or doc.get("image_url", "")
+            posts.append(doc)
+        if not posts:
+            self.stats["misses"] += 1
+            return posts
+        self.stats["served"] += len(posts)
+        await self._mark_active(company_id)
+        self.request_refill(company_id)
+        return posts
+
+    async def refill(self, company_id: str) -> int:
+        """
+        Drop the company's stale proposals and generate until the pool is full.
+        Only one process refills a company at a time, and only while it is enrolled
+        and not backing off after a failed refill. Returns the number of new posts.
+        """
+        if self.generate is None or company_id in self._refilling:
+            return 0
+        self._refilling.add(company_id)
+        try:
+            async with lease(f"post_pool:{company_id}", wait_seconds=1):
+                company = await get_collection(POST_POOL_COMPANIES_COLLECTION).find_one({
+                    "_id": company_id,
+                    "expires_at": {"$gt": _now()},
+                    "$or": [{"retry_at": {"$exists": False}}, {"retry_at": {"$lte": _now()}}]
+                })
+                if company is None:
+                    return 0
+                source = await pool_source(company_id)
+                await self._discard({
+                    "company_id": company_id,
+                    "pool_status": READY,
+                    "$nor": [_pooled(company_id, source)]
+                })
+                posts = get_collection(POSTS_COLLECTION)
+                ready = await posts.count_documents(_pooled(company_id, source))
+                if ready >= self.size:
+                    return 0
+                try:
+                    ids = await self._generate(company_id, source, ready)
+                except Exception:
+                    await self._back_off(company)
+                    raise
+                created = len(ids)
+                servable = {**_servable(company_id, await pool_source(company_id)), "post_id": {"$in": ids}}
+                if not ids or not await posts.count_documents(servable):
+                    # Nothing new to serve - do not pay for the same attempt every sweep
+                    await self._back_off(company)
+                elif company.get("refill_failures"):
+                    await get_collection(POST_POOL_COMPANIES_COLLECTION).update_one(
+                        {"_id": company_id}, {"$unset": {"refill_failures": "", "retry_at": ""}}
+                    )
+                if created:
+                    self.stats["generated"] += created
+                    logger.info("Pooled %s post proposals for company_id=%s", created, company_id)
+                return created
+        except LeaseTimeout:
+            # Another process is refilling this company right now
+            return 0
+        finally:
+            self._refilling.discard(company_id)
+
+    async def _generate(self, company_id: str, source: str, ready: int) -> List[str]:
+        # Generates until the pool is full; returns the ids of the pooled posts
+        posts = get_collection(POSTS_COLLECTION)
+        created: List[str] = []
+        for _ in range(MAX_RUNS_PER_REFILL):
+            if ready >= self.size:
+                break
+            # Posts carry pool fields from their first write, so an interrupted
+            # run leaves GENERATING posts for the sweep, not posts that look saved
+            generated = await self.generate(
+                company_id,
+                {"pool_status": GENERATING, "pool_source": source, "pooled_at": _now()}
+            )
+            ids = [post["post_id"] for post in generated]
+            if not ids:
+                break
+            # Generation may have built a new visual identity pack, which is part
+            # of the source - tag the batch with what it was actually made from
+            source = await pool_source(company_id)
+            await posts.update_many(
+                {"post_id": {"$in": ids}, "pool_status": GENERATING},
+                {"$set": {"pool_status": READY, "pool_source": source, "pooled_at": _now()}}
+            )
+            ready += len(ids)
+            created += ids
+        return created
+
+    async def _back_off(self, company: Dict[str, Any]) -> None:
+        failures = company.get("refill_failures", 0) + 1
+        delay = min(POST_POOL_RETRY_SECONDS * 2 ** (failures - 1), POST_POOL_MAX_RETRY_SECONDS)
+        await get_collection(POST_POOL_COMPANIES_COLLECTION).update_one(
+            {"_id": company["_id"]},
+            {"$set": {"refill_failures": failures, "retry_at": _now() + timedelta(seconds=delay)}}
+        )
+        logger.warning("Post pool refill for company_id=%s added nothing servable, retrying in %ss", company["_id"], delay)
+
+    async def _mark_active(self, company_id: str) -> None:
+        now = _now()
+        await get_collection(POST_POOL_COMPANIES_COLLECTION).update_one(
+            {"_id": company_id},
+            {"$set": {"last_requested_at": now, "expires_at": now + timedelta(seconds=POST_POOL_ACTIVE_SECONDS)}},
+            upsert=True
+        )
+
+    async def _discard(self, query: Dict[str, Any]) -> None:
+        posts = get_collection(POSTS_COLLECTION)
+        ids = [doc["post_id"] async for doc in posts.find(query, {"post_id": 1})]
+        if not ids:
+            return
+        await posts.delete_many({"post_id": {"$in": ids}, "pool_status": {"$exists": True}})
+        # Let the image GC collect what only these proposals used
+        for post_id in ids:
+            await remove_image_ref(f"post:{post_id}")
+        self.stats["discarded"] += len(ids)
+
+    async def _refill_safely(self, company_id: str) -> None:
+        async with self._semaphore:
+            try:
+                await self.refill(company_id)
+            except Exception as e:
+                logger.error("Refilling post pool for company_id=%s failed: %s", company_id, e)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_sweep = loop.time()
+        while not self._stopping:
+            try:
+                if loop.time() >= next_sweep:
+                    next_sweep = loop.time() + POST_POOL_INTERVAL_SECONDS
+                    now = _now()
+                    await self._discard({"$or": [
+                        {"pool_status": SERVED, "served_at": {"$lt": now - timedelta(seconds=POST_POOL_SERVED_RETENTION_SECONDS)}},
+                        {"pool_status": GENERATING, "pooled_at": {"$lt": now - timedelta(seconds=POST_POOL_GENERATING_TIMEOUT_SECONDS)}},
+                    ]})
+                    cursor = get_collection(POST_POOL_COMPANIES_COLLECTION).find(
+                        {"$or": [{"retry_at": {"$exists": False}}, {"retry_at": {"$lte": now}}]},
+                        {"_id": 1}
+                    )
+                    self._pending.update([doc["_id"] async for doc in cursor])
+                companies, self._pending = self._pending, set()
+                # Refills run side by side (bounded), so one slow company does not hold up the rest
+                for company_id in companies - self._refilling:
+                    task = asyncio.create_task(self._refill_safely(company_id))
+                    self._refills.add(task)
+                    task.add_done_callback(self._refills.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Post pool run failed: %s", e)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, next_sweep - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    def status(self) -> Dict[str, Any]:
+        return {"running": self._task is not None, "size": self.size, **self.stats}
+
+
+# Shared per-worker instance, started in the app lifespan
+post_pool = PostPool()
@@ -0,0 +1,296 @@
+import os
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import bson
+from bson.errors import InvalidDocument
+from pymongo import ReturnDocument
+from app.db.mongo import get_collection
+
+logger = logging.getLogger(__name__)
+
+JOBS_COLLECTION = "jobs"
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "5"))
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))
+# A running job whose heartbeat is older than this belonged to a dead process
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "120"))
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", str(7 * 24 * 3600)))
+# A job abandoned this many times (its process died while running it) is failed, not re-queued
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Backoff cap for retrying the write that records a finished job
+JOB_FINISH_RETRY_MAX_SECONDS = float(os.getenv("JOB_FINISH_RETRY_MAX_SECONDS", "30"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+# (company_id, params) -> JSON-serialisable result
+JobHandler = Callable[[str, Dict[str, Any]], Awaitable[Any]]
+
+
+class JobNotFound(Exception):
+    pass
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _public(doc: Dict[str, Any], include_result: bool = False) -> Dict[str, Any]:
+    job = {
+        "job_id": doc["_id"],
+        "kind": doc["kind"],
+        "company_id": doc["company_id"],
+        "status": doc["status"],
+        "error": doc.get("error"),
+        "created_at": doc.get("created_at"),
+        "started_at": doc.get("started_at"),
+        "finished_at": doc.get("finished_at"),
+    }
+    if include_result:
+        job["result"] = doc.get("result")
+    return job
+
+
+class JobQueue:
+    """
+    Bounded pool of workers running long agent calls outside the HTTP request.
+    Job state lives in MongoDB: workers claim queued jobs atomically, so several
+    API processes can share the queue and a restart picks up where it left off.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = max(1, workers)
+        self.handlers: Dict[str, JobHandler] = {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[str, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        self.handlers[kind] = handler
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        await self._requeue_stale()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info("Started %s job workers", self.workers)
+
+    async def stop(self) -> None:
+        # On Python 3.11 wait_for can swallow a cancel that races the wakeup,
+        # so the workers also check this flag
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Interrupted jobs go back to the queue for the next process
+        if self._running:
+            await get_collection(JOBS_COLLECTION).update_many(
+                {"_id": {"$in": list(self._running)}, "status": RUNNING, "owner": self.owner},
+                # A clean shutdown does not count against the job's attempts
+                {"$set": {"status": QUEUED}, "$unset": {"owner": "", "started_at": ""}, "$inc": {"attempts": -1}}
+            )
+            self._running.clear()
+
+    async def submit(self, kind: str, company_id: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        doc = {
+            "_id": str(bson.ObjectId()),
+            "kind": kind,
+            "company_id": company_id,
+            "params": params or {},
+            "status": QUEUED,
+            "attempts": 0,
+            "created_at": _now(),
+        }
+        await get_collection(JOBS_COLLECTION).insert_one(doc)
+        self._wakeup.set()
+        logger.info("Queued %s job %s for company_id=%s", kind, doc["_id"], company_id)
+        return _public(doc)
+
+    async def get(self, job_id: str, include_result: bool = False) -> Dict[str, Any]:
+        doc = await get_collection(JOBS_COLLECTION).find_one({"_id": job_id})
+        if not doc:
+            raise JobNotFound(job_id)
+        return _public(doc, include_result)
+
+    async def cancel(self, job_id: str) -> Dict[str, Any]:
+        """
+        Cancel a queued job immediately; a running job is interrupted by the
+        process executing it (here at once, elsewhere on its next heartbeat).
+        """
+        jobs = get_collection(JOBS_COLLECTION)
+        doc = await jobs.find_one_and_update(
+            {"_id": job_id, "status": QUEUED},
+            {"$set": {"status": CANCELLED, "finished_at": _now(), "expires_at": self._expiry()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc is None:
+            doc = await jobs.find_one_and_update(
+                {"_id": job_id, "status": RUNNING},
+                {"$set": {"cancel_requested": True}},
+                return_document=ReturnDocument.AFTER
+            )
+            if doc is not None and job_id in self._running:
+                self._running[job_id].cancel()
+        if doc is None:
+            doc = await jobs.find_one({"_id": job_id})
+        if doc is None:
+            raise JobNotFound(job_id)
+        return _public(doc)
+
+    def _expiry(self) -> datetime:
+        return _now() + timedelta(seconds=JOB_RESULT_TTL_SECONDS)
+
+    async def _requeue_stale(self) -> None:
+        jobs = get_collection(JOBS_COLLECTION)
+        cutoff = _now() - timedelta(seconds=JOB_STALE_SECONDS)
+        # Jobs that keep taking their process down are given up on
+        result = await jobs.update_many(
+            {"status": RUNNING, "heartbeat_at": {"$lt": cutoff}, "attempts": {"$gte": JOB_MAX_ATTEMPTS}},
+            {
+                "$set": {
+                    "status": FAILED,
+                    "error": f"Abandoned {JOB_MAX_ATTEMPTS} times by a stopped process",
+                    "finished_at": _now(),
+                    "expires_at": self._expiry()
+                },
+                "$unset": {"owner": ""}
+            }
+        )
+        if result.modified_count:
+            logger.error("Failed %s jobs that exhausted their attempts", result.modified_count)
+        result = await jobs.update_many(
+            {"status": RUNNING, "heartbeat_at": {"$lt": cutoff}},
+            {"$set": {"status": QUEUED}, "$unset": {"owner": "", "started_at": ""}}
+        )
+        if result.modified_count:
+            logger.warning("Re-queued %s jobs abandoned by a stopped process", result.modified_count)
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        now = _now()
+        return await get_collection(JOBS_COLLECTION).find_one_and_update(
+            {"status": QUEUED, "kind": {"$in": list(self.handlers)}},
+            {
+                "$set": {"status": RUNNING, "owner": self.owner, "started_at": now, "heartbeat_at": now},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _worker(self, index: int) -> None:
+        while not self._stopping:
+            try:
+                doc = await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Claiming a job failed: %s", e)
+                doc = None
+            if doc is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    # Idle: also pick up jobs left behind by crashed processes
+                    try:
+                        await self._requeue_stale()
+                    except Exception as e:
+                        logger.error("Re-queueing stale jobs failed: %s", e)
+                continue
+            try:
+                await self._execute(doc)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Keep the worker alive for the next job
+                logger.exception("Worker %s failed while running job %s: %s", index, doc["_id"], e)
+
+    async def _execute(self, doc: Dict[str, Any]) -> None:
+        job_id = doc["_id"]
+        task = asyncio.create_task(self.handlers[doc["kind"]](doc["company_id"], doc.get("params") or {}))
+        self._running[job_id] = task
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, task))
+        update: Dict[str, Any]
+        try:
+            # asyncio.wait does not propagate our own cancellation into the job,
+            # which tells a job cancel apart from the worker shutting down
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            # Shutting down: stop() re-queues the job
+            task.cancel()
+            heartbeat.cancel()
+            raise
+        try:
+            update = {"status": SUCCEEDED, "result": task.result()}
+        except asyncio.CancelledError:
+            update = {"status": CANCELLED}
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job_id, doc["kind"])
+            update = {"status": FAILED, "error": str(e)}
+        update.update({"finished_at": _now(), "expires_at": self._expiry()})
+        try:
+            # The heartbeat keeps running until the outcome is stored, so the stale
+            # sweep never re-queues (and re-runs) a job that has already finished
+            update = await self._finish(job_id, update)
+        finally:
+            self._running.pop(job_id, None)
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+        logger.info("Job %s (%s) finished: %s", job_id, doc["kind"], update["status"])
+
+    async def _finish(self, job_id: str, update: Dict[str, Any]) -> Dict[str, Any]:
+        """Store the job's final state, retrying with backoff until MongoDB accepts it."""
+        jobs = get_collection(JOBS_COLLECTION)
+        delay = 1.0
+        while True:
+            try:
+                await jobs.update_one({"_id": job_id, "owner": self.owner}, {"$set": update})
+                return update
+            except InvalidDocument as e:
+                if "result" not in update:
+                    raise
+                # A result MongoDB cannot store (unencodable, too large) - record the failure without it
+                logger.error("Storing result of job %s failed: %s", job_id, e)
+                update = {**update, "status": FAILED, "error": f"Could not store result: {str(e)}"}
+                update.pop("result")
+            except Exception as e:
+                logger.error("Recording the end of job %s failed, retrying in %ss: %s", job_id, delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, JOB_FINISH_RETRY_MAX_SECONDS)
+
+    async def _heartbeat(self, job_id: str, task: asyncio.Task) -> None:
+        # Runs until cancelled: past the end of the job, while its outcome is being stored
+        jobs = get_collection(JOBS_COLLECTION)
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                doc = await jobs.find_one_and_update(
+                    {"_id": job_id, "owner": self.owner},
+                    {"$set": {"heartbeat_at": _now()}},
+                    projection={"cancel_requested": 1}
+                )
+            except Exception as e:
+                logger.error("Job heartbeat for %s failed: %s", job_id, e)
+                continue
+            if (doc is None or doc.get("cancel_requested")) and not task.done():
+                # Cancelled elsewhere, or another process took the job over
+                task.cancel()
+
+
+# Shared per-worker instance, started in the app lifespan
+job_queue = JobQueue()
@@ -1,4 +1,5 @@
 from typing import List, Optional, Dict, Any
+from datetime import datetime
 from pydantic import BaseModel, HttpUrl, Field
 
 class GeneratePostsRequest(BaseModel):
@@ -40,8 +41,8 @@ class GenerateImageOutput(BaseModel):
     url: HttpUrl
 
 class ImageAgentOutput(BaseModel):
-    scene_description: str
-    image_url: HttpUrl
+    scene_description: str = ""
+    image_url: str = ""  # empty when image generation failed
 
 class CompanyContextRequest(BaseModel):
     user_response: Optional[str] = None
@@ -94,3 +95,14 @@ class PostEditRequest(BaseModel):
 class StrategyResponse(BaseModel):
     company_id: str
     strategy: Dict[str, Any]
+
+class JobResponse(BaseModel):
+    job_id: str
+    kind: str
+    company_id: str
+    status: str
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    result: Optional[Any] = None